@@ -0,0 +1,126 @@
+import io
+import os
+import wave
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import discord
+from dotenv import load_dotenv
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 環境変数をロード
+load_dotenv()
+
+# Discordの音声は 48kHz / ステレオ / 20ms ごとのOpusフレーム
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_SAMPLES = 960
+
+# ワーカープロセスごとに1つ作り、使い回すエンコーダー
+_encoder = None
+
+
+def encode_wav(wav_bytes):
+    # VoiceVoxのWAV（24kHz / モノラル / 16bit）を 48kHz ステレオにしてOpusフレームの並びにする
+    global _encoder
+    if _encoder is None:
+        _encoder = discord.opus.Encoder()
+
+    with wave.open(io.BytesIO(wav_bytes)) as wav:
+        rate = wav.getframerate()
+        channels = wav.getnchannels()
+        if wav.getsampwidth() != 2:
+            raise ValueError(f'16bit以外のWAVには対応していません: {wav.getsampwidth() * 8}bit')
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype='<i2')
+
+    mono = samples.reshape(-1, channels).mean(axis=1) if channels > 1 else samples.astype(np.float64)
+    if rate != SAMPLE_RATE and len(mono):
+        # 線形補間でリサンプリングする（音声合成の出力には十分な品質）
+        length = int(round(len(mono) * SAMPLE_RATE / rate))
+        mono = np.interp(np.arange(length) * (rate / SAMPLE_RATE), np.arange(len(mono)), mono)
+    pcm = np.clip(np.round(mono), -32768, 32767).astype('<i2')
+
+    # 最後のフレームが20msに満たなければ無音で埋める
+    padding = -len(pcm) % FRAME_SAMPLES
+    if padding:
+        pcm = np.concatenate([pcm, np.zeros(padding, dtype='<i2')])
+    stereo = np.repeat(pcm, CHANNELS).tobytes()
+
+    frame_bytes = FRAME_SAMPLES * CHANNELS * 2
+    return [_encoder.encode(stereo[i:i + frame_bytes], FRAME_SAMPLES)
+            for i in range(0, len(stereo), frame_bytes)]
+
+
+def _silence_wav():
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(24000)
+        wav.writeframes(b'\x00\x00' * 480)
+    return output.getvalue()
+
+
+class OpusFrames(discord.AudioSource):
+    # エンコード済みのOpusフレームをそのまま流す音声ソース
+
+    def __init__(self, packets):
+        self.packets = packets
+        self.position = 0
+
+    def read(self):
+        if self.position >= len(self.packets):
+            return b''
+        packet = self.packets[self.position]
+        self.position += 1
+        return packet
+
+    def is_opus(self):
+        return True
+
+
+class AudioEncoder:
+    # WAVからOpusフレームへの変換をプロセスプールで行い、再生時にffmpegを起動しないようにする
+    # NumPy や Opus ライブラリが使えない場合は無効になり、従来どおり ffmpeg で再生する
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+        self.enabled = False
+
+    @classmethod
+    def from_env(cls):
+        workers = os.getenv('AUDIO_ENCODER_WORKERS', '')
+        return cls(int(workers) if workers else max(1, (os.cpu_count() or 2) // 2))
+
+    async def start(self):
+        if self.workers <= 0 or self.executor is not None:
+            return
+        if np is None:
+            logging.warning('NumPyがインストールされていないため、音声はffmpegで変換します')
+            return
+        # Botのスレッド（MongoDB・aiohttp）が動いているプロセスを fork しないよう、spawn でワーカーを起動する
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            # ワーカーでOpusライブラリが読み込めるか確かめる
+            await asyncio.get_running_loop().run_in_executor(self.executor, encode_wav, _silence_wav())
+        except Exception as e:
+            logging.warning(f'Opusエンコーダーを起動できないため、音声はffmpegで変換します: {e}')
+            await self.close()
+            return
+        self.enabled = True
+        logging.info(f'Opusエンコーダーを{self.workers}プロセスで起動しました')
+
+    async def close(self):
+        self.enabled = False
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            await asyncio.to_thread(executor.shutdown, cancel_futures=True)
+
+    async def encode(self, wav_bytes):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, encode_wav, wav_bytes)
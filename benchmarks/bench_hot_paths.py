@@ -0,0 +1,242 @@
+# 読み上げのホットパス（辞書置き換え・URL/数字フィルタ・キュー・合成後の音声変換）のマイクロベンチマーク
+# VoiceVox・Discord・MongoDBには接続せず、オフラインで実行できる
+#
+# 使い方（リポジトリのルートで実行）:
+#   python benchmarks/bench_hot_paths.py                          結果を表示
+#   python benchmarks/bench_hot_paths.py --save baseline.json     結果を保存
+#   python benchmarks/bench_hot_paths.py --compare baseline.json  保存した結果と比較し、遅くなっていれば終了コード1
+#   python benchmarks/bench_hot_paths.py --filter replace         名前に replace を含むものだけ実行
+
+import os
+import io
+import sys
+import json
+import wave
+import random
+import shutil
+import argparse
+import itertools
+import statistics
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+from audio_encoder import encode_wav, np
+from dict_matcher import DictMatcher
+from speech_queue import SpeechEntry, SpeechQueue, split_sentences
+from synthesis_cache import SynthesisCache
+from text_filter import normalize_message
+
+SEED = 20240501
+DICT_SIZES = (10, 100, 1000, 10000)
+KANA = [chr(c) for c in range(0x30A1, 0x30F7)]
+KANJI = [chr(c) for c in range(0x4E00, 0x4E00 + 2000)]
+HIRAGANA = [chr(c) for c in range(0x3041, 0x3094)]
+
+
+def random_word(rng, length):
+    return ''.join(rng.choice(KANA + KANJI) for _ in range(length))
+
+
+def make_dict(rng, size):
+    custom_dict = {'_id': 'dummy', 'guild_id': 1}
+    for i in range(size):
+        custom_dict[str(i)] = {
+            'word': random_word(rng, rng.randint(2, 6)),
+            'pronunciation': ''.join(rng.choice(HIRAGANA) for _ in range(rng.randint(2, 8))),
+        }
+    return custom_dict
+
+
+def make_messages(rng, custom_dict, count=200):
+    # 辞書の単語を含む、チャットらしい長さのメッセージ
+    words = [entry['word'] for entry in custom_dict.values() if isinstance(entry, dict)]
+    messages = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(2, 6)):
+            parts.append(random_word(rng, rng.randint(3, 10)))
+            if words and rng.random() < 0.5:
+                parts.append(rng.choice(words))
+        messages.append('、'.join(parts) + rng.choice(['。', '！', 'w', '']))
+    return messages
+
+
+def make_filter_messages(rng, count=200):
+    messages = []
+    for _ in range(count):
+        base = random_word(rng, rng.randint(10, 60))
+        kind = rng.random()
+        if kind < 0.1:
+            base += ' https://example.com/' + random_word(rng, 8)
+        elif kind < 0.3:
+            base += str(rng.randint(0, 10 ** rng.randint(1, 12)))
+        elif kind < 0.4:
+            base += f' <@{rng.randint(10 ** 17, 10 ** 18)}> <:emoji:{rng.randint(10 ** 17, 10 ** 18)}>'
+        messages.append(base)
+    return messages
+
+
+def make_wav(seconds=2.0, rate=24000):
+    # VoiceVoxの出力と同じ 24kHz / モノラル / 16bit のWAV
+    rng = random.Random(SEED)
+    frames = bytes(rng.getrandbits(8) for _ in range(int(seconds * rate) * 2))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+def replace_words_linear(text, custom_dict):
+    # 以前の実装（辞書の件数だけ str.replace を繰り返す）。比較用
+    for entry in custom_dict.values():
+        if isinstance(entry, dict):
+            text = text.replace(entry['word'], entry['pronunciation'])
+    return text
+
+
+def run_sync(coro):
+    # メモリ上のキャッシュは中断しないので、イベントループなしで実行できる
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError('coroutine suspended')
+
+
+def build_benchmarks():
+    rng = random.Random(SEED)
+    benchmarks = {}
+
+    for size in DICT_SIZES:
+        custom_dict = make_dict(rng, size)
+        messages = make_messages(rng, custom_dict)
+        matcher = DictMatcher(custom_dict)
+        cycle = itertools.cycle(messages)
+        benchmarks[f'replace_words/dict={size}'] = lambda m=matcher, c=cycle: m.replace(next(c))
+        linear_cycle = itertools.cycle(messages)
+        benchmarks[f'replace_words_linear/dict={size}'] = \
+            lambda d=custom_dict, c=linear_cycle: replace_words_linear(next(c), d)
+        benchmarks[f'dict_compile/dict={size}'] = \
+            lambda d=custom_dict, text=messages[0]: DictMatcher(d).replace(text)
+
+        def dict_update(m=DictMatcher(custom_dict), text=messages[0], word=random_word(rng, 4)):
+            # /register_dict と /remove_dict の直後の置き換え
+            m.add('bench', word, 'よみ')
+            m.replace(text)
+            m.remove('bench')
+            m.replace(text)
+
+        benchmarks[f'dict_update/dict={size}'] = dict_update
+
+    filter_cycle = itertools.cycle(make_filter_messages(rng))
+    benchmarks['message_filter'] = lambda c=filter_cycle: normalize_message(next(c))
+
+    long_text = '。'.join(random_word(rng, rng.randint(5, 30)) for _ in range(40)) + '。'
+    benchmarks['split_sentences/long'] = lambda t=long_text: split_sentences(t)
+
+    for size in (1000, 10000):
+        entries = [('text', SpeechEntry(None, random_word(rng, 20))) for _ in range(size)]
+
+        def queue_push_pop(entries=entries):
+            queue = SpeechQueue(max_backlog=0, ttl=0)
+            for item in entries:
+                queue.append(item)
+            lane = queue.head_lane()
+            while lane:
+                lane.popleft()
+
+        def list_push_pop(entries=entries):
+            # 以前の実装（list.append と pop(0)）。比較用
+            queue = []
+            for item in entries:
+                queue.append(item)
+            while queue:
+                queue.pop(0)
+
+        benchmarks[f'queue_push_pop/{size}'] = queue_push_pop
+        benchmarks[f'queue_push_pop_list/{size}'] = list_push_pop
+
+    wav_bytes = make_wav()
+
+    # 合成後の音声の変換（Bot と同じく、NumPy と Opus が使えればOpusエンコード、使えなければ ffmpeg の起動）
+    try:
+        if np is None:
+            raise RuntimeError('NumPyがインストールされていません')
+        encode_wav(wav_bytes)
+    except Exception as e:
+        if shutil.which('ffmpeg') is None:
+            print(f'Opusエンコード（{e}）も ffmpeg も使えないため、音声変換の計測を省きます')
+        else:
+            print(f'Opusエンコードを計測できないため、ffmpeg の起動を計測します: {e}')
+
+            def ffmpeg_source():
+                source = discord.FFmpegPCMAudio(io.BytesIO(wav_bytes), pipe=True)
+                source.cleanup()
+
+            benchmarks['audio_source_ffmpeg/2s'] = ffmpeg_source
+    else:
+        benchmarks['audio_encode/2s'] = lambda: encode_wav(wav_bytes)
+
+    cache = SynthesisCache(64 * 1024 * 1024)
+    cache_texts = [random_word(rng, rng.randint(1, 10)) for _ in range(500)]
+    for text in cache_texts:
+        run_sync(cache.put(cache.make_key(text, 1, 1.0, 0, 1.0), wav_bytes))
+    cache_cycle = itertools.cycle(cache_texts)
+    benchmarks['synthesis_cache_hit'] = \
+        lambda c=cache_cycle: run_sync(cache.get(cache.make_key(next(c), 1, 1.0, 0, 1.0)))
+
+    return benchmarks
+
+
+def measure(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    timings = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {'best': min(timings), 'median': statistics.median(timings), 'number': number}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='読み上げホットパスのマイクロベンチマーク')
+    parser.add_argument('--filter', default='', help='名前にこの文字列を含むベンチマークだけ実行する')
+    parser.add_argument('--repeat', type=int, default=5, help='計測の繰り返し回数')
+    parser.add_argument('--save', help='結果をJSONで保存する')
+    parser.add_argument('--compare', help='保存済みのJSONと比較する')
+    parser.add_argument('--threshold', type=float, default=0.15, help='この割合以上遅くなったら劣化とみなす')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    regressions = []
+    for name, func in build_benchmarks().items():
+        if args.filter not in name:
+            continue
+        result = results[name] = measure(func, args.repeat)
+        line = f"{name:<36} best {result['best'] * 1e6:>12.2f} µs  median {result['median'] * 1e6:>12.2f} µs"
+        if name in baseline:
+            ratio = result['best'] / baseline[name]['best']
+            line += f"  x{ratio:.2f}"
+            if ratio > 1 + args.threshold:
+                line += '  劣化'
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'seed': SEED, 'python': sys.version, 'results': results}, f, indent=2)
+
+    if regressions:
+        print(f"{len(regressions)}件のベンチマークが {args.threshold:.0%} 以上遅くなりました: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+# event1 Cog のエンドツーエンド負荷試験
+# ローカルにスタブのVoiceVoxエンジンを立て、N個のサーバーに合成メッセージを流し込み、
+# 偽のボイスクライアントで再生して、メッセージから最初の音声までの遅延とスループットを計測する
+# DiscordのゲートウェイやMongoDB、実際のVoiceVoxは使わない
+#
+# 使い方（リポジトリのルートで実行）:
+#   python benchmarks/load_harness.py --guilds 50 --rate 0.5 --duration 30
+#   python benchmarks/load_harness.py --engines 2 --synthesis-delay 0.4 --json result.json
+
+import os
+import io
+import re
+import sys
+import json
+import wave
+import time
+import random
+import asyncio
+import argparse
+import threading
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # Cog が config.json を相対パスで読むため
+
+from aiohttp import web
+from voicevox_client import VoiceVoxClient
+from guild_dict_store import GuildDictCache
+
+TOKEN_PATTERN = re.compile(r'テスト(\d+)')
+SAMPLE_RATE = 24000
+
+
+class StubEngine:
+    # /audio_query と /synthesis に遅延を入れて返すスタブのVoiceVoxエンジン
+    # 合成結果のWAVには元のテキストを埋め込み、どのメッセージが再生されたか分かるようにする
+
+    def __init__(self, query_delay, synthesis_delay, synthesis_per_char, char_seconds):
+        self.query_delay = query_delay
+        self.synthesis_delay = synthesis_delay
+        self.synthesis_per_char = synthesis_per_char
+        self.char_seconds = char_seconds
+        self.requests = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/audio_query', self.audio_query)
+        app.router.add_post('/synthesis', self.synthesis)
+        app.router.add_get('/version', self.version)
+        return app
+
+    async def version(self, request):
+        return web.json_response('0.0.0-stub')
+
+    async def audio_query(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.query_delay)
+        return web.json_response({'text': request.query['text'], 'speedScale': 1.0,
+                                  'pitchScale': 0.0, 'intonationScale': 1.0})
+
+    async def synthesis(self, request):
+        self.requests += 1
+        query = await request.json()
+        text = query['text']
+        await asyncio.sleep(self.synthesis_delay + self.synthesis_per_char * len(text))
+        seconds = len(text) * self.char_seconds / max(query.get('speedScale') or 1.0, 0.1)
+        return web.Response(body=make_wav(text, seconds), content_type='audio/wav')
+
+
+def make_wav(text, seconds):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(b'\0\0' * int(seconds * SAMPLE_RATE))
+    # 末尾に独自チャンクとしてテキストを付ける（WAVとしては無視される）
+    payload = text.encode('utf-8')
+    if len(payload) % 2:
+        payload += b'\0'
+    return buffer.getvalue() + b'TEXT' + len(payload).to_bytes(4, 'little') + payload
+
+
+def read_wav(audio_content):
+    with wave.open(io.BytesIO(audio_content), 'rb') as wav:
+        seconds = wav.getnframes() / wav.getframerate()
+    text = ''
+    marker = audio_content.rfind(b'TEXT')
+    if marker >= 0:
+        size = int.from_bytes(audio_content[marker + 4:marker + 8], 'little')
+        text = audio_content[marker + 8:marker + 8 + size].rstrip(b'\0').decode('utf-8')
+    return text, seconds
+
+
+class FakeAudioSource:
+    def __init__(self, audio_content):
+        self.audio_content = audio_content
+
+
+class FakeObject:
+    def __init__(self, id, **kwargs):
+        self.id = id
+        self.__dict__.update(kwargs)
+
+
+class FakeVoiceClient:
+    # discord.VoiceClient の代わり。WAVの長さだけ待ってから、discordと同じく別スレッドで after を呼ぶ
+
+    def __init__(self, harness, guild, playback_scale):
+        self.harness = harness
+        self.guild = guild
+        self.channel = FakeObject(guild.id + 1, guild=guild, members=[])
+        self.playback_scale = playback_scale
+        self.playing = False
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self.playing
+
+    def stop(self):
+        self.playing = False
+
+    def play(self, source, after=None):
+        if self.playing:
+            self.harness.errors += 1
+            raise RuntimeError('Already playing audio.')
+        self.playing = True
+        text, seconds = read_wav(source.audio_content)
+        self.harness.on_play(self.guild.id, text)
+
+        def finish():
+            self.playing = False
+            if after is not None:
+                after(None)
+
+        threading.Timer(seconds * self.playback_scale, finish).start()
+
+
+class FakeUserSettings:
+    async def get(self, user_id):
+        return {'intensity': 1.0, 'pitch': 0, 'speed': 1.0}
+
+
+class FakeBot:
+    def __init__(self, voicevox):
+        self.user = FakeObject(0, name='harness')
+        self.voice_clients = []
+        self.voicevox = voicevox
+        self.user_settings = FakeUserSettings()
+        # 辞書は空のものを事前に入れておき、MongoDBには問い合わせない
+        self.guild_dicts = GuildDictCache(None, max_guilds=10 ** 6, check_interval=0)
+        # 再生は FakeAudioSource で行うため、Opusへの変換はしない
+        self.audio_encoder = None
+        self.loop = asyncio.get_running_loop()
+
+    def get_channel(self, channel_id):
+        return None
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.sent = {}  # seq -> 送信時刻
+        self.first_audio = {}  # seq -> 最初に音声が再生された時刻
+        self.depth_samples = []  # (経過秒, 合計の待ち件数, 最大の待ち件数)
+        self.plays = 0
+        self.errors = 0
+        self.started = 0.0
+
+    def on_play(self, guild_id, text):
+        now = time.perf_counter()
+        self.plays += 1
+        for seq in TOKEN_PATTERN.findall(text):
+            self.first_audio.setdefault(int(seq), now)
+
+    async def start_engines(self):
+        engines = []
+        runners = []
+        for i in range(self.args.engines):
+            engine = StubEngine(self.args.query_delay, self.args.synthesis_delay,
+                                self.args.synthesis_per_char, self.args.char_seconds)
+            runner = web.AppRunner(engine.app())
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', self.args.port + i)
+            await site.start()
+            engines.append(engine)
+            runners.append(runner)
+        return engines, runners
+
+    async def sample_depth(self, cog):
+        while True:
+            depths = [len(queue) for queue in cog.audio_queue.values()]
+            self.depth_samples.append((time.perf_counter() - self.started, sum(depths), max(depths, default=0)))
+            await asyncio.sleep(self.args.sample_interval)
+
+    async def produce(self, cog, guild, channel, rng, seq_counter):
+        author = FakeObject(guild.id * 10, name='user', display_name='user')
+        deadline = self.started + self.args.duration
+        while True:
+            # ポアソン到着
+            await asyncio.sleep(rng.expovariate(self.args.rate))
+            if time.perf_counter() >= deadline:
+                return
+            seq = next(seq_counter)
+            length = rng.randint(self.args.min_chars, self.args.max_chars)
+            content = f"テスト{seq}" + 'あ' * max(length - 3, 0)
+            message = FakeObject(seq, content=content, author=author, guild=guild, channel=channel, attachments=[],
+                                 mentions=[], role_mentions=[], channel_mentions=[])
+            self.sent[seq] = time.perf_counter()
+            # discord.py と同じく、イベントごとに別タスクで処理する
+            asyncio.create_task(cog.on_message(message))
+
+    async def run(self):
+        from cogs.yomievent import event1
+
+        engines, runners = await self.start_engines()
+        voicevox = VoiceVoxClient([f'http://127.0.0.1:{self.args.port + i}' for i in range(self.args.engines)],
+                                  pool_size=self.args.pool_size, timeout=30, health_interval=0)
+        await voicevox.start()
+
+        bot = FakeBot(voicevox)
+        cog = event1(bot)
+        cog.create_audio_source = FakeAudioSource
+
+        guilds = []
+        for i in range(self.args.guilds):
+            guild = FakeObject(1000 + i * 10)
+            channel = FakeObject(guild.id + 2, name='harness')
+            guild.voice_client = FakeVoiceClient(self, guild, self.args.playback_scale)
+            bot.voice_clients.append(guild.voice_client)
+            cog.guild_text_channels[guild.id] = channel.id
+            bot.guild_dicts.put(guild.id, {})
+            guilds.append((guild, channel))
+
+        rng = random.Random(self.args.seed)
+        seq_counter = iter(range(1, 10 ** 9))
+        self.started = time.perf_counter()
+        sampler = asyncio.create_task(self.sample_depth(cog))
+        await asyncio.gather(*(self.produce(cog, guild, channel, random.Random(rng.random()), seq_counter)
+                               for guild, channel in guilds))
+
+        # 送信を止めたあと、キューが空になるまで（最大 drain_timeout 秒）待つ
+        drain_deadline = time.perf_counter() + self.args.drain_timeout
+        while time.perf_counter() < drain_deadline:
+            if not any(len(queue) for queue in cog.audio_queue.values()) and \
+                    not any(vc.is_playing() for vc in bot.voice_clients):
+                break
+            await asyncio.sleep(0.1)
+        finished = time.perf_counter()
+        sampler.cancel()
+
+        await voicevox.close()
+        for runner in runners:
+            await runner.cleanup()
+        return self.report(engines, finished - self.started)
+
+    def report(self, engines, elapsed):
+        latencies = sorted(self.first_audio[seq] - self.sent[seq] for seq in self.first_audio if seq in self.sent)
+
+        def percentile(p):
+            if not latencies:
+                return float('nan')
+            return latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))]
+
+        result = {
+            'guilds': self.args.guilds,
+            'engines': self.args.engines,
+            'sent': len(self.sent),
+            'played': len(latencies),
+            'dropped': len(self.sent) - len(latencies),
+            'elapsed': elapsed,
+            'messages_per_second': len(latencies) / elapsed if elapsed else 0.0,
+            'plays': self.plays,
+            'play_errors': self.errors,
+            'engine_requests': sum(engine.requests for engine in engines),
+            'latency': {
+                'p50': percentile(50),
+                'p95': percentile(95),
+                'p99': percentile(99),
+                'mean': statistics.mean(latencies) if latencies else float('nan'),
+            },
+            'queue_depth': [{'t': round(t, 2), 'total': total, 'max': peak} for t, total, peak in self.depth_samples],
+        }
+
+        print(f"サーバー数 {result['guilds']} / エンジン数 {result['engines']} / {elapsed:.1f}秒")
+        print(f"送信 {result['sent']}件  再生 {result['played']}件  破棄 {result['dropped']}件  "
+              f"再生回数 {result['plays']}  再生エラー {result['play_errors']}  エンジンへのリクエスト {result['engine_requests']}")
+        print(f"スループット {result['messages_per_second']:.2f} メッセージ/秒")
+        latency = result['latency']
+        print(f"最初の音声までの遅延  p50 {latency['p50'] * 1000:.0f}ms  p95 {latency['p95'] * 1000:.0f}ms  "
+              f"p99 {latency['p99'] * 1000:.0f}ms")
+        print('待ち件数の推移（1秒ごと、合計/最大）:')
+        last_second = -1
+        for t, total, peak in self.depth_samples:
+            if int(t) != last_second:
+                last_second = int(t)
+                print(f"  {last_second:>4}s  {total:>5} / {peak:>4}")
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='event1 Cog の負荷試験')
+    parser.add_argument('--guilds', type=int, default=20, help='サーバー数')
+    parser.add_argument('--rate', type=float, default=0.5, help='1サーバーあたりの毎秒メッセージ数')
+    parser.add_argument('--duration', type=float, default=20.0, help='メッセージを送る秒数')
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help='送信後にキューが空になるまで待つ最大秒数')
+    parser.add_argument('--min-chars', type=int, default=5)
+    parser.add_argument('--max-chars', type=int, default=40)
+    parser.add_argument('--engines', type=int, default=1, help='起動するスタブエンジンの数')
+    parser.add_argument('--port', type=int, default=50121, help='スタブエンジンの最初のポート')
+    parser.add_argument('--pool-size', type=int, default=20)
+    parser.add_argument('--query-delay', type=float, default=0.05, help='/audio_query の遅延（秒）')
+    parser.add_argument('--synthesis-delay', type=float, default=0.2, help='/synthesis の固定遅延（秒）')
+    parser.add_argument('--synthesis-per-char', type=float, default=0.005, help='/synthesis の1文字あたりの遅延（秒）')
+    parser.add_argument('--char-seconds', type=float, default=0.1, help='合成音声の1文字あたりの長さ（秒）')
+    parser.add_argument('--playback-scale', type=float, default=1.0, help='再生時間の倍率（小さくすると早く終わる）')
+    parser.add_argument('--sample-interval', type=float, default=0.25, help='待ち件数を記録する間隔（秒）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='結果をJSONで保存する')
+    args = parser.parse_args()
+
+    result = asyncio.run(Harness(args).run())
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,8 +7,8 @@ class ReadyCog(commands.Cog):
 
     @commands.Cog.listener()
     async def on_ready(self):
+        # on_ready は再接続のたびに呼ばれるため、コマンドの同期は setup_hook で1回だけ行う
         latency = self.bot.latency * 1000
-        await self.bot.tree.sync()
         await self.bot.change_presence(activity=discord.Game(name=f"ping値{latency:.2f}ms"))
 
         print(f"{self.bot.user.name} がログインしました！")
@@ -19,6 +19,13 @@ class ReadyCog(commands.Cog):
         )
         print(f"Invite link: {invite_link}")
 
+    @commands.command(name='sync')
+    @commands.is_owner()
+    async def sync(self, ctx):
+        # コマンド定義に変更がなくても強制的に同期する（Botのオーナーのみ）
+        await self.bot.sync_commands(force=True)
+        await ctx.send("コマンドを同期しました。")
+
 
 async def setup(bot):
     await bot.add_cog(ReadyCog(bot))
\ No newline at end of file
@@ -0,0 +1,79 @@
+from discord.ext import commands
+from discord import Embed
+from metrics import metrics
+
+# /stats に表示する段階（メッセージ受信から再生開始までの順）
+STAGES = (
+    ('mongo_guild_dict', '辞書の読み込み'),
+    ('dict_replace', '辞書の置き換え'),
+    ('user_settings', 'ユーザー設定'),
+    ('queue_wait', 'キュー待ち'),
+    ('synthesis', '音声合成'),
+    ('synthesis_slot_wait', '合成の順番待ち'),
+    ('audio_encode', 'Opusエンコード'),
+    ('synthesis_wait', '合成待ち（再生停止）'),
+    ('audio_source', '音声ソース作成'),
+    ('first_audio', '受信〜再生開始'),
+)
+
+
+def format_ms(seconds):
+    return f'{seconds * 1000:.0f}ms'
+
+
+class StatsCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.hybrid_command(name='stats', description='読み上げの各段階の所要時間と合成エンジンの状態を表示します（管理者のみ）')
+    @commands.has_permissions(administrator=True)
+    async def stats(self, ctx, scope: str = 'guild'):
+        # scope に all を指定すると全サーバーの合計を表示する
+        labels = {} if scope == 'all' or ctx.guild is None else {'guild': ctx.guild.id}
+        title = '読み上げ統計（全サーバー）' if not labels else f'読み上げ統計（{ctx.guild.name}）'
+        embed = Embed(title=title, color=0x00ff00)
+
+        lines = []
+        for name, label in STAGES:
+            histogram = metrics.aggregate(name, **labels)
+            if not histogram.count:
+                continue
+            lines.append(f'{label}: {histogram.count}回 平均{format_ms(histogram.sum / histogram.count)} '
+                         f'p50 {format_ms(histogram.quantile(0.5))} p95 {format_ms(histogram.quantile(0.95))}')
+        embed.add_field(name='所要時間', value='\n'.join(lines) or 'まだ記録がありません', inline=False)
+
+        embed.add_field(name='件数', value=(
+            f'再生: {metrics.counter_total("played_clips", **labels)}\n'
+            f'破棄: {metrics.counter_total("dropped_messages", **labels)}'
+        ), inline=False)
+
+        if self.bot.voicevox.cache is not None:
+            cache = self.bot.voicevox.cache.stats()
+            embed.add_field(name='合成キャッシュ', value=(
+                f'{cache["entries"]}件 {cache["bytes"] / 1024 / 1024:.1f}MB '
+                f'(ディスク {cache["disk_entries"]}件) ヒット率 {cache["hit_rate"] * 100:.1f}%'
+            ), inline=False)
+
+        engines = []
+        for engine in self.bot.voicevox.engines:
+            request = metrics.aggregate('voicevox_request', endpoint=engine.url)
+            state = '正常' if engine.healthy else '切り離し中'
+            if self.bot.voicevox.warmup_speakers:
+                state += f' 話者{len(engine.loaded)}/{len(self.bot.voicevox.warmup_speakers)}'
+            engines.append(f'{engine.url}: {state} 処理中{engine.outstanding} '
+                           f'p95 {format_ms(request.quantile(0.95))} '
+                           f'エラー{metrics.counter_total("voicevox_errors", endpoint=engine.url)}')
+        embed.add_field(name='VoiceVoxエンジン', value='\n'.join(engines) or 'なし', inline=False)
+
+        await ctx.send(embed=embed)
+
+    @stats.error
+    async def stats_error(self, ctx, error):
+        if isinstance(error, commands.MissingPermissions):
+            await ctx.send('このコマンドは管理者のみ使用できます。')
+        else:
+            raise error
+
+
+async def setup(bot):
+    await bot.add_cog(StatsCog(bot))
@@ -1,118 +1,41 @@
-import os
-import re
-import uuid
 import logging
-import aiohttp
-import asyncio
 import json  # JSONを扱うためのモジュールを追加
-from pymongo import MongoClient
-from dotenv import load_dotenv
 import discord
 from discord.ext import commands
-from discord import Embed, Interaction
-from discord.ui import Button, View
-from collections import deque
-from datetime import datetime
-import math
 
 logging.basicConfig(level=logging.INFO)
 
-# 環境変数をロード
-load_dotenv()
-
-# 環境変数からMongoDBとVoiceVoxのURLを取得
-MONGODB_URL = os.getenv('MONGODB_URL')
-VOICEVOX_URL = os.getenv('VOICEVOX_URL')
+# MongoDB・VoiceVoxにはBot共有のストア・クライアントを通してアクセスする
 
 # JSON設定ファイルを読み込む
 with open('config.json', 'r', encoding='utf-8') as config_file:
     config = json.load(config_file)
 
 # 設定を取得
-DEFAULT_SPEAKER_ID = config['default_speaker_id']
 SPEAKER_STYLE_OPTIONS = config['speaker_style_options']
 
-mongo_client = MongoClient(MONGODB_URL)
-db = mongo_client['discord_bot_db']
-user_settings_collection = db['user_settings']
-guild_dicts_collection = db['guild_dicts']
-
-
-def load_user_settings():
-    settings = user_settings_collection.find_one({})
-    return settings if settings else {}
-
-def save_user_settings(settings):
-    user_settings_collection.update_one({}, {"$set": settings}, upsert=True)
-
-def load_guild_dict(guild_id):
-    guild_dict = guild_dicts_collection.find_one({'guild_id': guild_id})
-    return guild_dict if guild_dict else {}
-
-def save_guild_dict(guild_id, custom_dict):
-    custom_dict['guild_id'] = guild_id
-    guild_dicts_collection.update_one({'guild_id': guild_id}, {"$set": custom_dict}, upsert=True)
-
-
-
-
 
 class Voice(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.audio_queue = {}  # サーバーごとにキューを持つ
-        self.is_playing = {}
-        self.user_settings = load_user_settings()
-        self.guild_dicts = {}
         self.text_channel_id = None
-        self.voicevox_url = VOICEVOX_URL  # 環境変数から取得
         self.guild_text_channels = {} 
 
     def get_guild_text_channel(self, guild_id):
         return self.bot.get_channel(self.guild_text_channels.get(guild_id))
     
-    async def create_and_save_audio(self, text, filename):
-        speaker_id = DEFAULT_SPEAKER_ID  # システムメッセージ用のデフォルト話者
-        async with aiohttp.ClientSession() as session:
-            query_url = f"{self.voicevox_url}/audio_query"
-            params = {'text': text, 'speaker': speaker_id}
-            async with session.post(query_url, params=params) as query_resp:
-                query_resp.raise_for_status()
-                audio_query = await query_resp.json()
-
-            synthesis_url = f"{self.voicevox_url}/synthesis"
-            async with session.post(synthesis_url, params={'speaker': speaker_id}, json=audio_query) as synthesis_resp:
-                synthesis_resp.raise_for_status()
-                audio_content = await synthesis_resp.read()
-
-        with open(filename, 'wb') as audio_file:
-            audio_file.write(audio_content)
-
-    async def play_saved_audio(self, filename, guild):
-        voice_client = discord.utils.get(self.bot.voice_clients, guild=guild)
-        if voice_client:
-            voice_client.play(discord.FFmpegPCMAudio(filename))
-            self.is_playing = True
-
-
     @commands.hybrid_command(name='skip', description='現在再生中の音声をスキップします')
     async def skip_audio(self, ctx):
-        if self.is_playing and self.current_voice_client and self.current_voice_client.is_playing():
-            self.current_voice_client.stop()
+        # 再生はサーバーごとの再生タスクが行っているため、このサーバーのボイスクライアントだけを止める
+        # （止めると再生タスクが次のメッセージに進む）
+        voice_client = ctx.guild.voice_client if ctx.guild else None
+        if voice_client and voice_client.is_playing():
+            voice_client.stop()
             await ctx.send("再生中の音声をスキップしました。")
         else:
             await ctx.send("読み上げていませんので実行できません。")
 
-    async def play_saved_audio(self, filename, guild):
-        voice_client = discord.utils.get(self.bot.voice_clients, guild=guild)
-        self.current_voice_client = voice_client
-        if not voice_client:
-            logging.error("ボイスチャンネルに接続されていません。再生できません。")
-            return
-        voice_client.play(discord.FFmpegPCMAudio(filename), after=lambda e: self.after_play_audio(e))
-        self.is_playing = True
-
     @commands.hybrid_command(name='set_speaker', description='ユーザーごとの話者およびスタイルを設定します')
     @discord.app_commands.choices(
         speaker_name=[
@@ -138,8 +61,7 @@ class Voice(commands.Cog):
 
         style_id = SPEAKER_STYLE_OPTIONS[speaker_name].get(style_name, SPEAKER_STYLE_OPTIONS[speaker_name]['ノーマル'])
 
-        self.user_settings[str(ctx.author.id)] = style_id
-        save_user_settings(self.user_settings)
+        self.bot.user_settings.set_speaker(ctx.author.id, style_id)
         await ctx.send(f"{ctx.author.name} の話者が {speaker_name}（スタイル: {style_name}）に設定されました。")
 
 
@@ -203,18 +125,8 @@ class Voice(commands.Cog):
         else:
             user_id = str(ctx.user.id)
 
-        settings = {
-            'intensity': intensity.value,
-            'pitch': pitch.value,
-            'speed': speed.value
-        }
-
-        # MongoDBに設定を保存
-        user_settings_collection.update_one(
-            {'user_id': user_id},
-            {'$set': settings},
-            upsert=True
-        )
+        # メモリ上の設定を更新し、MongoDBへは後からまとめて保存する
+        self.bot.user_settings.set_voice_settings(user_id, intensity.value, pitch.value, speed.value)
 
         response_msg = f"音声設定を更新しました: 抑揚={intensity.name}, 音高={pitch.name}, 話速={speed.name}"
 
@@ -1,11 +1,14 @@
 import os
+import io
 import re
+import time
 import uuid
 import logging
 import aiohttp
 import asyncio
 import json  # JSONを扱うためのモジュールを追加
-from pymongo import MongoClient
+import csv
+from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 import discord
 from discord.ext import commands
@@ -14,15 +17,19 @@ from discord.ui import Button, View
 from collections import deque
 from datetime import datetime
 import math
+from guild_dict_store import parse_dict_file, format_dict_file
+from speech_queue import SpeechEntry, SpeechQueue, adaptive_speed
+from text_filter import normalize_message
+from metrics import metrics
+from audio_encoder import OpusFrames
 
 logging.basicConfig(level=logging.INFO)
 
 # 環境変数をロード
 load_dotenv()
 
-# 環境変数からMongoDBとVoiceVoxのURLを取得
+# 環境変数からMongoDBのURLを取得（VoiceVoxはBot共有のクライアントを使う）
 MONGODB_URL = os.getenv('MONGODB_URL')
-VOICEVOX_URL = os.getenv('VOICEVOX_URL')
 
 # JSON設定ファイルを読み込む
 with open('config.json', 'r', encoding='utf-8') as config_file:
@@ -32,75 +39,88 @@ with open('config.json', 'r', encoding='utf-8') as config_file:
 DEFAULT_SPEAKER_ID = config['default_speaker_id']
 SPEAKER_STYLE_OPTIONS = config['speaker_style_options']
 
-mongo_client = MongoClient(MONGODB_URL)
+# 再生中に先読みで合成しておくキューの件数
+PREFETCH_DEPTH = int(os.getenv('SYNTHESIS_PREFETCH_DEPTH', '3'))
+# 画像として扱う添付ファイルの拡張子
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg', 'gif')
+# 辞書の読みに使える文字（ひらがな・カタカナ）
+PRONUNCIATION_PATTERN = re.compile(r'^[\u3040-\u309F\u30A0-\u30FF]+$')
+# 一括登録で受け付けるファイルの最大サイズ
+DICT_IMPORT_MAX_BYTES = int(float(os.getenv('DICT_IMPORT_MAX_MB', '8')) * 1024 * 1024)
+# 読み上げるものがないまま、この秒数が過ぎたら再生タスクを終える
+PLAYER_IDLE_TIMEOUT = 300
+# 起動時にボイスチャンネルへ同時に再接続する数と、失敗時の再試行回数
+VOICE_RESTORE_CONCURRENCY = int(os.getenv('VOICE_RESTORE_CONCURRENCY', '10'))
+VOICE_RESTORE_RETRIES = 2
+# 読み上げる最大文字数
+MAX_READ_LENGTH = int(os.getenv('MAX_READ_LENGTH', '1000'))
+# 混雑時に1回の合成へまとめるメッセージの最大件数と最大文字数
+SYNTHESIS_BATCH_SIZE = int(os.getenv('SYNTHESIS_BATCH_SIZE', '5'))
+SYNTHESIS_BATCH_LENGTH = int(os.getenv('SYNTHESIS_BATCH_LENGTH', '200'))
+
+# イベントループを止めないよう、MongoDBには非同期ドライバ(motor)でアクセスする
+mongo_client = AsyncIOMotorClient(MONGODB_URL)
 db = mongo_client['discord_bot_db']
-user_settings_collection = db['user_settings']
-guild_dicts_collection = db['guild_dicts']
+# サーバー辞書はBot共有の bot.guild_dicts（上限付きのキャッシュ）を通して読み書きする
 nicknames_collection = db['nicknames']
 
-def load_user_settings():
-    settings = user_settings_collection.find_one({})
-    return settings if settings else {}
 
-def save_user_settings(settings):
-    user_settings_collection.update_one({}, {"$set": settings}, upsert=True)
-
-def load_guild_dict(guild_id: int):
-    guild_dict = guild_dicts_collection.find_one({'guild_id': guild_id})
-    return guild_dict if guild_dict else {}
-
-def save_guild_dict(guild_id: int, custom_dict):
-    custom_dict['guild_id'] = guild_id
-    guild_dicts_collection.update_one({'guild_id': guild_id}, {"$set": custom_dict}, upsert=True)
-
-
-def load_nicknames():
-    nicknames = nicknames_collection.find_one({})
+async def load_nicknames():
+    nicknames = await nicknames_collection.find_one({})
     return nicknames if nicknames else {}
 
-def save_nicknames(nicknames):
-    nicknames_collection.update_one({}, {"$set": nicknames}, upsert=True)
+async def save_nicknames(nicknames):
+    await nicknames_collection.update_one({}, {"$set": nicknames}, upsert=True)
+
+def new_entry_id():
+    return str(uuid.uuid4().int >> 64)
 
 class event1(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.audio_queue = {}  # サーバーごとにキューを持つ
-        self.is_playing = {}
-        self.user_settings = load_user_settings()
-        self.guild_dicts = {}
+        self.audio_queue = {}  # サーバーごとに SpeechQueue を持つ
+        self.players = {}  # サーバーごとの再生タスク
+        self.wakeups = {}  # 再生タスクに新しいメッセージを知らせるイベント
         self.text_channel_id = None
-        self.voicevox_url = VOICEVOX_URL  # 環境変数から取得
-        self.nicknames = load_nicknames()
+        self.nicknames = {}
         self.guild_text_channels = {} 
+        self.sessions_restored = False
+        self.restore_task = None
 
+    async def cog_load(self):
+        self.nicknames = await load_nicknames()
 
-    async def create_and_save_audio(self, text, filename):
-        speaker_id = DEFAULT_SPEAKER_ID  # システムメッセージ用のデフォルト話者
-        async with aiohttp.ClientSession() as session:
-            query_url = f"{self.voicevox_url}/audio_query"
-            params = {'text': text, 'speaker': speaker_id}
-            async with session.post(query_url, params=params) as query_resp:
-                query_resp.raise_for_status()
-                audio_query = await query_resp.json()
+    async def cog_unload(self):
+        for task in self.players.values():
+            task.cancel()
+        if self.restore_task is not None:
+            self.restore_task.cancel()
 
-            synthesis_url = f"{self.voicevox_url}/synthesis"
-            async with session.post(synthesis_url, params={'speaker': speaker_id}, json=audio_query) as synthesis_resp:
-                synthesis_resp.raise_for_status()
-                audio_content = await synthesis_resp.read()
 
-        with open(filename, 'wb') as audio_file:
-            audio_file.write(audio_content)
+    def get_guild_text_channel(self, guild_id):
+        return self.bot.get_channel(self.guild_text_channels.get(guild_id))
 
-    async def play_saved_audio(self, filename, guild):
-        voice_client = discord.utils.get(self.bot.voice_clients, guild=guild)
-        if voice_client:
-            voice_client.play(discord.FFmpegPCMAudio(filename))
-            self.is_playing = True
+    def get_queue(self, guild_id):
+        queue = self.audio_queue.get(guild_id)
+        if queue is None:
+            queue = self.audio_queue[guild_id] = SpeechQueue()
+        return queue
 
+    def discard(self, guild_id, items):
+        # 上限超過・期限切れで読まずに捨てたメッセージの合成を止める
+        for message_type, content in items:
+            if message_type == 'text':
+                content.cancel()
+                metrics.inc('dropped_messages', guild=guild_id)
+        if items:
+            logging.info(f'Guild {guild_id}: {len(items)}件のメッセージを読まずに破棄しました')
 
-    def get_guild_text_channel(self, guild_id):
-        return self.bot.get_channel(self.guild_text_channels.get(guild_id))
+    async def get_guild_dict(self, guild_id: int):
+        return (await self.bot.guild_dicts.get(guild_id)).entries
+
+    async def get_dict_matcher(self, guild_id: int):
+        return (await self.bot.guild_dicts.get(guild_id)).matcher
 
 
     @commands.hybrid_command(name='vc', description='ボイスチャンネルに参加し、このテキストチャンネルのメッセージを読み上げます')
@@ -112,6 +132,8 @@ class event1(commands.Cog):
         
         # コマンドを実行したチャンネルを通知用テキストチャンネルとして保存
             self.guild_text_channels[ctx.guild.id] = ctx.channel.id
+            # 再起動後に接続し直せるよう保存しておく
+            await self.bot.voice_sessions.save(ctx.guild.id, channel.id, ctx.channel.id)
 
             text_channel_url = f"https://discord.com/channels/{ctx.guild.id}/{ctx.channel.id}"
 
@@ -129,27 +151,22 @@ class event1(commands.Cog):
 
     @commands.hybrid_command(name='register_dict', description='辞書にカスタム読みを登録します')
     async def register_dict(self, ctx, word: str, pronunciation: str):
-        if not re.match(r'^[\u3040-\u309F\u30A0-\u30FF]+$', pronunciation):
+        if not PRONUNCIATION_PATTERN.match(pronunciation):
             await ctx.send('発音にはひらがなまたはカタカナを使用してください。')
             return
 
         # 文字列化はせず、整数のまま取得する
         guild_id = ctx.guild.id
 
-        # DB から読み出したり、self.guild_dicts にすでにあれば使う
-        custom_dict = self.guild_dicts.setdefault(guild_id, load_guild_dict(guild_id))
-
-        entry_id = str(uuid.uuid4().int >> 64)
+        entry_id = new_entry_id()
         entry = {
             "word": word,
             "pronunciation": pronunciation,
             "user": ctx.author.name,
             "time": datetime.now().strftime("%Y/%m/%d:%H:%M")
         }
-        custom_dict[entry_id] = entry
-
-        # 保存時も guild_id を int のまま渡す
-        save_guild_dict(guild_id, custom_dict)
+        # 保存時も guild_id を int のまま渡す（キャッシュを更新し、DBにはこの1件だけを書き込む）
+        await self.bot.guild_dicts.add(guild_id, entry_id, entry)
 
         embed = Embed(title="辞書", 
                       description="設定が変更されました", 
@@ -165,115 +182,269 @@ class event1(commands.Cog):
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        if message.author == self.bot.user:
+        # 読み上げ対象のチャンネル以外は何もせずに抜ける
+        if message.guild is None or message.author == self.bot.user:
             return
-
         guild_id = message.guild.id
-        custom_dict = self.guild_dicts.get(guild_id, {})
-
-    # もし self.guild_dicts に入っていなければ DB から読む
-        if not custom_dict:
-            custom_dict = load_guild_dict(guild_id)
-            self.guild_dicts[guild_id] = custom_dict
-
-        text = message.content  # メッセージ内容をテキストに格納
-
-    # 置き換え処理
-        text = replace_words(text, custom_dict)
-        target_channel_id = self.guild_text_channels.get(guild_id)
-
-        if target_channel_id is None or message.channel.id != target_channel_id:
+        if message.channel.id != self.guild_text_channels.get(guild_id):
             return
-
-        if 'http://' in message.content or 'https://' in message.content:
+        # ボイスチャンネルに接続していなければ合成しない
+        if message.guild.voice_client is None:
             return
 
-        numbers = re.findall(r'\d+', message.content)
-        if any(int(num) >= 100_000_000 for num in numbers):
-            return
+        # Check for attachments and add to queue
+        for attachment in message.attachments:
+            if attachment.filename.lower().endswith(IMAGE_EXTENSIONS):
+                self.discard(guild_id, self.get_queue(guild_id).append(('image', attachment.url)))
 
-    # Check for attachments and add to queue
-        if message.attachments:
-            for attachment in message.attachments:
-                if any(attachment.filename.lower().endswith(ext) for ext in ['png', 'jpg', 'jpeg', 'gif']):
-                    self.audio_queue.setdefault(guild_id, []).append(('image', attachment.url))
-
-        self.audio_queue.setdefault(guild_id, []).append(('text', message))
-
-        if not self.is_playing.get(guild_id, False):
-            await self.play_audio(guild_id)
-
-    async def play_audio(self, guild_id):
-        if guild_id not in self.audio_queue or not self.audio_queue[guild_id]:
+        # URL・メンション・絵文字・長い数字を読める形にしてから、辞書で置き換える
+        text = normalize_message(message.content, self.mention_names(message))
+        if text is None:
             return
-
-        message_type, content = self.audio_queue[guild_id].pop(0)
+        matcher = await self.get_dict_matcher(guild_id)
+        with metrics.timer('dict_replace', guild=guild_id):
+            text = matcher.replace(text)
+        await self.enqueue_text(guild_id, message, text)
+
+    @staticmethod
+    def mention_names(message):
+        if not (message.mentions or message.role_mentions or message.channel_mentions):
+            return None
+        names = {str(user.id): user.display_name for user in message.mentions}
+        names.update((str(role.id), role.name) for role in message.role_mentions)
+        names.update((str(channel.id), channel.name) for channel in message.channel_mentions)
+        return names
+
+    async def enqueue_text(self, guild_id, message, text, priority=False):
+        if len(text) > MAX_READ_LENGTH:
+            text = text[:MAX_READ_LENGTH] + "以下略"
+
+        entry = SpeechEntry(message, text)
+        if not entry.chunks:
+            return
+        # ユーザー設定の読み込みを待つ間に後のメッセージが追い越さないよう、先に順番を確保する
+        item = ('text', entry)
+        queue = self.get_queue(guild_id)
+        self.discard(guild_id, queue.append(item, priority=priority))
+        try:
+            entry.voice = await self.resolve_voice(message)
+        except Exception:
+            queue.remove(item)
+            raise
+        self.prefetch(guild_id)
+        self.ensure_player(guild_id)
+
+    async def resolve_voice(self, message):
+        with metrics.timer('user_settings', guild=message.guild.id):
+            user_settings = await self.bot.user_settings.get(message.author.id)
+        return (user_settings.get('speaker_id', DEFAULT_SPEAKER_ID),
+                user_settings['intensity'], user_settings['pitch'], user_settings['speed'])
+
+    def prefetch(self, guild_id):
+        # 再生中に、キュー先頭から PREFETCH_DEPTH 文分の合成を並行して始めておく
+        queue = self.audio_queue.get(guild_id)
+        if not queue:
+            return
+        self.discard(guild_id, queue.expire())
+
+        depth = 0
+        for lane in queue.lanes():
+            position = 0
+            while position < len(lane):
+                message_type, content = lane[position]
+                # 声の設定を読み込み中のメッセージは、読み込み終わってから合成する
+                if message_type == 'text' and content.voice is not None:
+                    if not content.tasks:
+                        content = self.coalesce(lane, position)
+                    for index in range(content.index, len(content.chunks)):
+                        if depth >= PREFETCH_DEPTH:
+                            return
+                        self.start_synthesis(content, index)
+                        depth += 1
+                position += 1
+
+    def coalesce(self, lane, position):
+        # 同じ声・設定で未合成の短いメッセージが続いていれば、1回の合成・1つの音声にまとめる
+        first = lane[position][1]
+        if len(first.chunks) != 1:
+            return first
+
+        batch = [first]
+        length = len(first.chunks[0])
+        end = position + 1
+        while end < len(lane) and len(batch) < SYNTHESIS_BATCH_SIZE:
+            message_type, content = lane[end]
+            if (message_type != 'text' or content.tasks or len(content.chunks) != 1
+                    or content.voice is None or content.voice != first.voice
+                    or length + len(content.chunks[0]) > SYNTHESIS_BATCH_LENGTH):
+                break
+            batch.append(content)
+            length += len(content.chunks[0])
+            end += 1
+
+        if len(batch) == 1:
+            return first
+        merged = SpeechEntry.merge(batch)
+        for _ in range(end - position - 1):
+            del lane[position + 1]
+        lane[position] = ('text', merged)
+        return merged
+
+    def start_synthesis(self, entry, index):
+        task = entry.tasks.get(index)
+        if task is None:
+            task = entry.tasks[index] = asyncio.create_task(self.synthesize_entry(entry, index))
+        return task
+
+    def clear_queue(self, guild_id):
+        queue = self.audio_queue.pop(guild_id, None)
+        if queue:
+            for message_type, content in queue.clear():
+                if message_type == 'text':
+                    content.cancel()
+
+    async def synthesize_entry(self, entry, index):
+        message, text = entry.message, entry.chunks[index]
+
+        # デバッグ: 置換前後のメッセージ
+        logging.debug(f"Original Text: {message.content}")
+        logging.debug(f"Replaced Text ({index + 1}/{len(entry.chunks)}): {text}")
+
+        speaker_id, intensity, pitch, speed = entry.voice
+        # 読み上げ待ちが溜まっているほど速く読み、実時間に追いつく
+        speed = adaptive_speed(speed, len(self.get_queue(message.guild.id)))
+        with metrics.timer('synthesis', guild=message.guild.id):
+            audio_content = await self.bot.voicevox.synthesize(
+                text, speaker_id, intensity=intensity, pitch=pitch, speed=speed, guild=message.guild.id)
+        return await self.encode_audio(message.guild.id, audio_content)
+
+    async def encode_audio(self, guild_id, audio_content):
+        # 先読みの段階でOpusフレームまで作っておき、再生時はそのまま流す
+        encoder = self.bot.audio_encoder
+        if encoder is None or not encoder.enabled:
+            return audio_content
+        try:
+            with metrics.timer('audio_encode', guild=guild_id):
+                return await encoder.encode(audio_content)
+        except Exception as e:
+            logging.warning(f'Opusへの変換に失敗したため、ffmpegで再生します: {e}')
+            return audio_content
+
+    def ensure_player(self, guild_id):
+        # サーバーごとに1つの再生タスクがキューを順に読み上げる。止まっていれば起こす
+        wakeup = self.wakeups.get(guild_id)
+        if wakeup is None:
+            wakeup = self.wakeups[guild_id] = asyncio.Event()
+        wakeup.set()
+        if guild_id not in self.players:
+            self.players[guild_id] = asyncio.create_task(self.player_loop(guild_id))
+
+    async def player_loop(self, guild_id):
+        wakeup = self.wakeups[guild_id]
+        try:
+            while True:
+                queue = self.audio_queue.get(guild_id)
+                if queue:
+                    self.discard(guild_id, queue.expire())
+                if not queue or not self.head_ready(queue):
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout=PLAYER_IDLE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        # しばらく何も来なければタスクを終え、次のメッセージで作り直す
+                        if not self.audio_queue.get(guild_id):
+                            return
+                    continue
+
+                try:
+                    await self.play_next(guild_id, queue)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(f'Guild {guild_id}: 再生中にエラーが発生しました: {e}')
+        finally:
+            if self.players.get(guild_id) is asyncio.current_task():
+                del self.players[guild_id]
+                self.wakeups.pop(guild_id, None)
+
+    @staticmethod
+    def head_ready(queue):
+        # 先頭のメッセージが声の設定を読み込み中なら、読み込み終わって起こされるまで待つ
+        message_type, content = queue.head_lane()[0]
+        return message_type != 'text' or content.voice is not None
+
+    async def play_next(self, guild_id, queue):
+        # 優先レーン（システム・入室メッセージ）があればそちらを先に読む
+        lane = queue.head_lane()
+        if lane[0][0] == 'text' and not lane[0][1].tasks:
+            self.coalesce(lane, 0)
+        message_type, content = lane[0]
         voice_client = discord.utils.get(self.bot.voice_clients, guild__id=guild_id)
 
         if not voice_client:
             logging.error('Voice client is not connected for audio playback.')
+            self.discard(guild_id, [lane.popleft()])
             return
 
         if message_type == 'image':
+            lane.popleft()
             await self.send_image(guild_id, content)
-        else:
-            message = content
-            text = message.content
+            return
 
-        # デバッグ: 置換前のメッセージ
-            logging.debug(f"Original Text: {text}")
+        entry = content
+        first_chunk = entry.index == 0
+        if first_chunk:
+            metrics.observe('queue_wait', time.monotonic() - entry.created, guild=guild_id)
+        task = self.start_synthesis(entry, entry.index)
+        entry.index += 1
+        # 残りの文があれば先頭に残し、再生中に続きを合成しておく
+        if entry.index >= len(entry.chunks):
+            lane.popleft()
+        self.prefetch(guild_id)
 
-            custom_dict = self.guild_dicts.get(guild_id, {})
-            text = replace_words(text, custom_dict)
+        try:
+            # 先読みが間に合わず、再生が止まって待った時間
+            with metrics.timer('synthesis_wait', guild=guild_id):
+                audio_content = await task
+        except asyncio.CancelledError:
+            # キューの消去・破棄で合成だけが止められた場合は、再生タスクは続ける
+            if entry.cancelled and task.cancelled():
+                return
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f'VoiceVox APIエラー: {e}')
+            return
 
-        # デバッグ: 置換後のメッセージ
-            logging.debug(f"Replaced Text: {text}")
+        with metrics.timer('audio_source', guild=guild_id):
+            audio_source = self.create_audio_source(audio_content)
 
-            if len(text) > 500:
-                text = text[:10] + "以下略"
+        # 再生の終了は音声スレッドから通知されるため、イベントループ側の Future に渡して待つ
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
 
-            try:
-                user_id = str(message.author.id)
-                speaker_id = self.user_settings.get(user_id, DEFAULT_SPEAKER_ID)
-                user_settings = user_settings_collection.find_one({'user_id': user_id}) or {}
-                intensity = user_settings.get('intensity', 1.0)
-                pitch = user_settings.get('pitch', 0)
-                speed = user_settings.get('speed', 1.0)
-
-                async with aiohttp.ClientSession() as session:
-                    query_url = f"{self.voicevox_url}/audio_query"
-                    params = {'text': text, 'speaker': speaker_id}
-                    async with session.post(query_url, params=params) as query_resp:
-                        query_resp.raise_for_status()
-                        audio_query = await query_resp.json()
-                        audio_query['intonationScale'] = intensity
-                        audio_query['pitchScale'] = pitch
-                        audio_query['speedScale'] = speed
-
-                    synthesis_url = f"{self.voicevox_url}/synthesis"
-                    async with session.post(synthesis_url, params={'speaker': speaker_id}, json=audio_query) as synthesis_resp:
-                        synthesis_resp.raise_for_status()
-                        audio_content = await synthesis_resp.read()
-
-                audio_filename = f"voice_output_{uuid.uuid4()}.wav"
-                with open(audio_filename, 'wb') as audio_file:
-                    audio_file.write(audio_content)
-
-                self.is_playing[guild_id] = True
-
-                def after_playing(error):
-                    if os.path.exists(audio_filename):
-                        os.remove(audio_filename)
-                    self.is_playing[guild_id] = False
-                    future = asyncio.run_coroutine_threadsafe(self.play_audio(guild_id), self.bot.loop)
-                    future.result()
-
-                voice_client.play(discord.FFmpegPCMAudio(audio_filename), after=after_playing)
-
-            except aiohttp.ClientError as e:
-                logging.error(f'VoiceVox APIエラー: {e}')
-                self.is_playing[guild_id] = False
-                await self.play_audio(guild_id)
+        def after_playing(error):
+            loop.call_soon_threadsafe(self.finish_playing, finished, error)
+
+        voice_client.play(audio_source, after=after_playing)
+        metrics.inc('played_clips', guild=guild_id)
+        if first_chunk:
+            metrics.observe('first_audio', time.monotonic() - entry.created, guild=guild_id)
+
+        error = await finished
+        if error is not None:
+            logging.error(f'Guild {guild_id}: 再生エラー: {error}')
+
+    @staticmethod
+    def finish_playing(finished, error):
+        if not finished.done():
+            finished.set_result(error)
+
+    def create_audio_source(self, audio_content):
+        # エンコード済みならOpusフレームをそのまま流す
+        if isinstance(audio_content, list):
+            return OpusFrames(audio_content)
+        # 一時ファイルを作らず、メモリ上のWAVをパイプでffmpegに渡す
+        return discord.FFmpegPCMAudio(io.BytesIO(audio_content), pipe=True)
 
     async def send_image(self, guild_id, image_url):
         # This method is a placeholder to handle image sending
@@ -286,6 +457,9 @@ class event1(commands.Cog):
         guild_id = member.guild.id
 
         try:
+            if member.id == self.bot.user.id:
+                await self.update_voice_session(guild_id, before, after)
+
             if before.channel is None and after.channel is not None:
                 if member.voice:
                     voice_client = discord.utils.get(self.bot.voice_clients, guild=member.guild)
@@ -300,10 +474,8 @@ class event1(commands.Cog):
                             message.author = member
                             message.channel = self.get_guild_text_channel(after.channel.guild.id)
 
-                            self.audio_queue[guild_id].append(message)
-
-                            if not self.is_playing[guild_id]:
-                                await self.play_audio(guild_id)
+                            text = (await self.get_dict_matcher(guild_id)).replace(text)
+                            await self.enqueue_text(guild_id, message, text, priority=True)
 
             if before.channel is not None and after.channel is None:
                 await self.handle_channel_empty(before.channel)
@@ -315,14 +487,92 @@ class event1(commands.Cog):
     
         pass
 
+    async def update_voice_session(self, guild_id, before, after):
+        # Bot自身の移動・切断を保存しておく（終了処理での切断は、再起動後に戻れるよう残す）
+        if before.channel == after.channel:
+            return
+        if after.channel is None:
+            # 切断したサーバーのチャットはもう読み上げない
+            self.guild_text_channels.pop(guild_id, None)
+        if self.bot.is_closed():
+            return
+        if after.channel is None:
+            await self.bot.voice_sessions.remove(guild_id)
+        elif before.channel is not None:
+            await self.bot.voice_sessions.update_voice_channel(guild_id, after.channel.id)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready は再接続のたびに呼ばれるため、復元は起動後の1回だけ行う
+        if self.sessions_restored:
+            return
+        self.sessions_restored = True
+        self.restore_task = asyncio.create_task(self.restore_voice_sessions())
+
+    async def restore_voice_sessions(self):
+        start = time.perf_counter()
+        try:
+            sessions = await self.bot.voice_sessions.load_all()
+        except Exception as e:
+            logging.error(f'保存したボイスチャンネルの読み込みに失敗しました: {e}')
+            # 次に on_ready が呼ばれたときにもう一度試す
+            self.sessions_restored = False
+            return
+        # 接続は同時に VOICE_RESTORE_CONCURRENCY 件まで。ゲートウェイへの送信はシャードごとに discord.py が間隔を調整する
+        semaphore = asyncio.Semaphore(VOICE_RESTORE_CONCURRENCY)
+
+        async def restore(guild_id, voice_channel_id, text_channel_id):
+            async with semaphore:
+                return await self.restore_voice_session(guild_id, voice_channel_id, text_channel_id)
+
+        # 他のプロセスが担当するシャードのサーバーは、そのプロセスに任せる
+        results = await asyncio.gather(*(restore(guild_id, voice_channel_id, text_channel_id)
+                                         for guild_id, (voice_channel_id, text_channel_id) in sessions.items()
+                                         if self.bot.get_guild(guild_id) is not None),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f'ボイスチャンネルへの再接続中にエラーが発生しました: {result}')
+        results = [result is True for result in results]
+        elapsed = time.perf_counter() - start
+        metrics.observe('voice_restore', elapsed)
+        if results:
+            logging.info(f'ボイスチャンネルへの再接続: {sum(results)}/{len(results)}件 ({elapsed:.1f}秒)')
+
+    async def restore_voice_session(self, guild_id, voice_channel_id, text_channel_id):
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(voice_channel_id)
+        text_channel = guild.get_channel(text_channel_id)
+        # チャンネルが消えた、または誰もいなくなったサーバーには戻らない
+        if channel is None or text_channel is None or not any(not m.bot for m in channel.members):
+            await self.bot.voice_sessions.remove(guild_id)
+            return False
+
+        self.guild_text_channels[guild_id] = text_channel_id
+        if guild.voice_client is not None:
+            return True
+        for attempt in range(VOICE_RESTORE_RETRIES + 1):
+            try:
+                await channel.connect(timeout=30.0)
+                return True
+            except (discord.ClientException, asyncio.TimeoutError, discord.HTTPException) as e:
+                if guild.voice_client is not None:
+                    return True
+                if attempt >= VOICE_RESTORE_RETRIES:
+                    logging.error(f'Guild {guild_id}: ボイスチャンネルに再接続できませんでした: {e}')
+                    return False
+                await asyncio.sleep(2 ** attempt)
+
     async def handle_channel_empty(self, channel):
         guild_id = channel.guild.id
         if len(channel.members) == 1 and channel.members[0].id == self.bot.user.id:
             voice_client = discord.utils.get(self.bot.voice_clients, guild=channel.guild)
             if voice_client and voice_client.is_connected():
+                # 切断するとテキストチャンネルの紐付けが消えるため、先に取得しておく
+                text_channel = self.get_guild_text_channel(guild_id)
                 await voice_client.disconnect()
+                self.clear_queue(guild_id)
 
-                text_channel = self.get_guild_text_channel(guild_id)
                 if text_channel:
                     await text_channel.send('ボイスチャンネルに誰もいなくなったため、退出しました。')
 
@@ -331,8 +581,8 @@ class event1(commands.Cog):
     @commands.hybrid_command(name='list_dict', description='登録された辞書の一覧を表示します')
 
     async def list_dict(self, ctx):
-        guild_id = str(ctx.guild.id)
-        custom_dict = self.guild_dicts.get(guild_id, load_guild_dict(guild_id))
+        guild_id = ctx.guild.id
+        custom_dict = {k: v for k, v in (await self.get_guild_dict(guild_id)).items() if isinstance(v, dict)}
         if not custom_dict:
             await ctx.send('辞書にはまだ登録がありません。')
             return
@@ -379,22 +629,69 @@ class event1(commands.Cog):
 
     @commands.hybrid_command(name='remove_dict', description='辞書から指定された単語を削除します')
     async def remove_dict(self, ctx, word: str):
-        guild_id = str(ctx.guild.id)
-        custom_dict = self.guild_dicts.setdefault(guild_id, load_guild_dict(guild_id))
+        guild_id = ctx.guild.id
+        custom_dict = await self.get_guild_dict(guild_id)
 
         found = False
         for entry_id, entry in list(custom_dict.items()):
             if isinstance(entry, dict) and entry.get('word') == word:
-                del custom_dict[entry_id]
+                await self.bot.guild_dicts.remove(guild_id, entry_id)
                 found = True
                 break
 
         if found:
-            save_guild_dict(guild_id, custom_dict)
             await ctx.send(f'"{word}" を辞書から削除しました。')
         else:
             await ctx.send(f'"{word}" は辞書に登録されていません。')
 
+    @commands.hybrid_command(name='import_dict', description='CSV（単語,読み）またはJSONファイルから辞書を一括登録します')
+    @commands.has_permissions(manage_guild=True)
+    async def import_dict(self, ctx, file: discord.Attachment):
+        guild_id = ctx.guild.id
+        if file.size > DICT_IMPORT_MAX_BYTES:
+            await ctx.send(f'ファイルが大きすぎます（上限 {DICT_IMPORT_MAX_BYTES // 1024 // 1024}MB）。')
+            return
+        await ctx.defer()
+
+        try:
+            pairs = parse_dict_file(file.filename, await file.read())
+        except (ValueError, TypeError, csv.Error) as e:
+            await ctx.send(f'ファイルを読み込めませんでした: {e}')
+            return
+        valid = [(word, pronunciation) for word, pronunciation in pairs
+                 if word and PRONUNCIATION_PATTERN.match(pronunciation)]
+        if not valid:
+            await ctx.send('登録できる単語がありませんでした。読みはひらがなまたはカタカナで指定してください。')
+            return
+
+        count = await self.bot.guild_dicts.bulk_import(guild_id, valid, ctx.author.name, new_entry_id)
+
+        embed = Embed(title="辞書", description="一括登録しました", color=0x66cdaa)
+        embed.add_field(name="登録", value=f'{count}件', inline=True)
+        embed.add_field(name="スキップ", value=f'{len(pairs) - len(valid)}件', inline=True)
+        await ctx.send(embed=embed)
+
+    @import_dict.error
+    async def import_dict_error(self, ctx, error):
+        if isinstance(error, commands.MissingPermissions):
+            await ctx.send('一括登録はサーバー管理の権限を持つユーザーのみ使用できます。')
+        else:
+            raise error
+
+    @commands.hybrid_command(name='export_dict', description='辞書をCSVまたはJSONファイルで出力します')
+    async def export_dict(self, ctx, file_format: str = 'csv'):
+        file_format = file_format.lower()
+        if file_format not in ('csv', 'json'):
+            await ctx.send('形式は csv または json を指定してください。')
+            return
+        custom_dict = await self.get_guild_dict(ctx.guild.id)
+        if not custom_dict:
+            await ctx.send('辞書にはまだ登録がありません。')
+            return
+        data = format_dict_file(custom_dict, file_format)
+        await ctx.send(f'{len(custom_dict)}件の辞書を出力しました。',
+                       file=discord.File(io.BytesIO(data), filename=f'dict_{ctx.guild.id}.{file_format}'))
+
     def get_guild_text_channel(self, guild_id):
         return self.bot.get_channel(self.guild_text_channels.get(guild_id))
 
@@ -402,17 +699,6 @@ class event1(commands.Cog):
 async def setup(bot):
     await bot.add_cog(event1(bot))
 
-def replace_words(text, custom_dict):
-    # 各エントリーを確認し、wordに対する置き換えを行う
-    for entry_id, entry in custom_dict.items():
-        if isinstance(entry, dict):
-            word = entry['word']
-            pronunciation = entry['pronunciation']
-            # メッセージ中の単語(word)を置き換える
-            text = text.replace(word, pronunciation)
-    return text
-
-
 class DummyMessage:
     def __init__(self, bot, content, guild):
         self.bot = bot  # botを保存します
@@ -0,0 +1,134 @@
+import re
+
+# これより単語が多い辞書は正規表現ではなく、先頭文字ごとの長さ表で探す
+# （re の選択肢は先頭から順に試されるため、単語数が多いと1文字ごとのコストが増える）
+REGEX_MAX_WORDS = 256
+
+
+class DictMatcher:
+    # ギルド辞書を1回の走査で最長一致の置き換えを行う形にまとめる
+    # 小さい辞書はトライ木から作った1つの正規表現、大きい辞書は先頭文字ごとの長さ表を使う
+
+    def __init__(self, custom_dict=None):
+        self.words = {}  # word -> {entry_id: pronunciation}（登録順、先に登録された読みを優先）
+        self.entry_words = {}  # entry_id -> word
+        self._pattern = None
+        self._lookup = {}  # word -> 置き換えに使う読み
+        self._lengths = {}  # 先頭文字 -> その文字で始まる単語の長さ（長い順）
+        self._length_counts = {}  # 先頭文字 -> {長さ: 単語数}
+        self._dirty = False  # 正規表現を作り直す必要があるか
+        if custom_dict:
+            self.load(custom_dict)
+
+    def load(self, custom_dict):
+        for entry_id, entry in custom_dict.items():
+            if isinstance(entry, dict):
+                self.add(entry_id, entry.get('word'), entry.get('pronunciation'))
+
+    def add(self, entry_id, word, pronunciation):
+        if not word or pronunciation is None:
+            return
+        self.remove(entry_id)
+        entries = self.words.get(word)
+        if entries is None:
+            entries = self.words[word] = {}
+            self._lookup[word] = pronunciation
+            self._count_length(word, 1)
+        entries[entry_id] = pronunciation
+        self.entry_words[entry_id] = word
+        self._dirty = True
+
+    def remove(self, entry_id):
+        word = self.entry_words.pop(entry_id, None)
+        if word is None:
+            return
+        entries = self.words.get(word, {})
+        entries.pop(entry_id, None)
+        if entries:
+            self._lookup[word] = next(iter(entries.values()))
+        else:
+            self.words.pop(word, None)
+            self._lookup.pop(word, None)
+            self._count_length(word, -1)
+        self._dirty = True
+
+    def _count_length(self, word, delta):
+        # 長さ表は変更のあった先頭文字の分だけ更新する
+        counts = self._length_counts.setdefault(word[0], {})
+        length = len(word)
+        count = counts.get(length, 0) + delta
+        if count > 0:
+            counts[length] = count
+            if count > delta:
+                return
+        else:
+            counts.pop(length, None)
+        if counts:
+            self._lengths[word[0]] = sorted(counts, reverse=True)
+        else:
+            del self._length_counts[word[0]]
+            self._lengths.pop(word[0], None)
+
+    def __len__(self):
+        return len(self.words)
+
+    def replace(self, text):
+        if not text or not self.words:
+            return text
+        # 大きい辞書は登録・削除のたびに更新している長さ表で探す
+        if len(self._lookup) > REGEX_MAX_WORDS:
+            return self._scan(text)
+        # 小さい辞書は変更があった場合のみ、次の置き換え時にまとめて再コンパイルする
+        if self._dirty or self._pattern is None:
+            self._compile()
+        return self._pattern.sub(self._substitute, text)
+
+    def _substitute(self, match):
+        return self._lookup[match.group(0)]
+
+    def _scan(self, text):
+        lookup = self._lookup
+        lengths = self._lengths
+        parts = []
+        last = 0
+        i = 0
+        n = len(text)
+        while i < n:
+            for length in lengths.get(text[i], ()):
+                pronunciation = lookup.get(text[i:i + length])
+                if pronunciation is not None:
+                    parts.append(text[last:i])
+                    parts.append(pronunciation)
+                    i += length
+                    last = i
+                    break
+            else:
+                i += 1
+        if not parts:
+            return text
+        parts.append(text[last:])
+        return ''.join(parts)
+
+    def _compile(self):
+        self._dirty = False
+        trie = {}
+        for word in self._lookup:
+            node = trie
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[''] = True
+        self._pattern = re.compile(_trie_to_regex(trie))
+
+
+def _trie_to_regex(node):
+    # 貪欲な "?" により長い候補を先に試すため、同じ位置では最長一致になる
+    terminal = '' in node
+    alternatives = [re.escape(ch) + _trie_to_regex(child) for ch, child in sorted(node.items()) if ch != '']
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1 and not terminal:
+        return alternatives[0]
+    pattern = '(?:' + '|'.join(alternatives) + ')'
+    if terminal:
+        pattern += '?'
+    return pattern
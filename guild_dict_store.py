@@ -0,0 +1,323 @@
+import io
+import os
+import csv
+import json
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from dotenv import load_dotenv
+from dict_matcher import DictMatcher
+from metrics import metrics
+
+# 環境変数をロード
+load_dotenv()
+
+# 一括登録で1回の bulk_write にまとめる件数
+DICT_BULK_BATCH_SIZE = int(os.getenv('DICT_BULK_BATCH_SIZE', '1000'))
+# 重複キーのエラーコード（複数プロセスで同時に移行した場合など）
+DUPLICATE_KEY_ERROR = 11000
+# change stream が使えない（レプリカセットでない）場合のエラーコード
+CHANGE_STREAM_UNSUPPORTED_ERRORS = (40573, 40324)
+# 再開トークンが古すぎて続きから読めない場合のエラーコード
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class GuildDictStore:
+    # サーバー辞書を1単語1ドキュメントで保存する。登録・削除はその1件だけを書き換える
+
+    def __init__(self, collection, versions, legacy_collection=None, batch_size=DICT_BULK_BATCH_SIZE):
+        self.collection = collection
+        # サーバーごとの版番号（_id がサーバーID）。辞書を書き換えるたびに1つ増やす
+        self.versions = versions
+        self.legacy_collection = legacy_collection  # 以前のサーバーごとに1ドキュメントの形式
+        self.batch_size = batch_size
+        # 自分のプロセスの書き込みを見分けるための印
+        self.token = uuid.uuid4().hex
+        self.writes = 0
+
+    @classmethod
+    def from_env(cls):
+        db = AsyncIOMotorClient(os.getenv('MONGODB_URL'))['discord_bot_db']
+        return cls(db['guild_dict_entries'], db['guild_dict_versions'], legacy_collection=db['guild_dicts'])
+
+    async def start(self):
+        await self.collection.create_index([('guild_id', ASCENDING), ('entry_id', ASCENDING)], unique=True)
+        await self.collection.create_index([('guild_id', ASCENDING), ('word', ASCENDING)])
+        if self.legacy_collection is not None:
+            await self.migrate()
+
+    async def migrate(self):
+        # 以前の形式の辞書を1単語1ドキュメントに移し、移し終えたら元のドキュメントを消す
+        async for legacy in self.legacy_collection.find({}):
+            guild_id = legacy.get('guild_id')
+            entries = [(entry_id, entry) for entry_id, entry in legacy.items()
+                       if entry_id not in ('_id', 'guild_id') and isinstance(entry, dict)]
+            if guild_id is not None:
+                await self.bulk_write(guild_id, [
+                    UpdateOne({'guild_id': guild_id, 'entry_id': entry_id},
+                              {'$setOnInsert': self._document(guild_id, entry_id, entry)}, upsert=True)
+                    for entry_id, entry in entries
+                ])
+                logging.info(f'Guild {guild_id}: 辞書 {len(entries)}件を新しい形式に移行しました')
+            await self.legacy_collection.delete_one({'_id': legacy['_id']})
+
+    @staticmethod
+    def _document(guild_id, entry_id, entry):
+        return {
+            'guild_id': guild_id,
+            'entry_id': entry_id,
+            'word': entry.get('word'),
+            'pronunciation': entry.get('pronunciation'),
+            'user': entry.get('user'),
+            'time': entry.get('time'),
+        }
+
+    async def load(self, guild_id):
+        # entry_id -> {'word', 'pronunciation', 'user', 'time'}（登録順）
+        custom_dict = {}
+        cursor = self.collection.find({'guild_id': guild_id}, {'_id': 0, 'guild_id': 0}).sort('_id', ASCENDING)
+        async for doc in cursor:
+            custom_dict[doc.pop('entry_id')] = doc
+        return custom_dict
+
+    async def add(self, guild_id, entry_id, entry):
+        await self.collection.update_one({'guild_id': guild_id, 'entry_id': entry_id},
+                                         {'$set': self._document(guild_id, entry_id, entry)}, upsert=True)
+
+    async def remove(self, guild_id, entry_id):
+        result = await self.collection.delete_one({'guild_id': guild_id, 'entry_id': entry_id})
+        return result.deleted_count > 0
+
+    async def version(self, guild_id):
+        doc = await self.versions.find_one({'_id': guild_id})
+        return doc['version'] if doc else 0
+
+    async def bump(self, guild_id):
+        # 版番号を1つ増やし、増やした後の値を返す
+        # writer は毎回変わる値にし、change stream の変更項目に必ず含まれるようにする
+        self.writes += 1
+        doc = await self.versions.find_one_and_update(
+            {'_id': guild_id}, {'$inc': {'version': 1}, '$set': {'writer': f'{self.token}:{self.writes}'}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        return doc['version']
+
+    async def bulk_import(self, guild_id, pairs, user, new_entry_id):
+        # (単語, 読み) の並びをまとめて登録する。同じ単語がすでにあれば読みを上書きする
+        time = datetime.now().strftime("%Y/%m/%d:%H:%M")
+        # 同じ単語が何度も出てくる場合は最後の読みを使う（同じバッチ内で重複して作られないように）
+        pairs = dict(pairs)
+        requests = [
+            UpdateOne({'guild_id': guild_id, 'word': word},
+                      {'$set': {'pronunciation': pronunciation, 'user': user, 'time': time},
+                       '$setOnInsert': {'entry_id': new_entry_id()}},
+                      upsert=True)
+            for word, pronunciation in pairs.items()
+        ]
+        await self.bulk_write(guild_id, requests)
+        return len(requests)
+
+    async def bulk_write(self, guild_id, requests):
+        for start in range(0, len(requests), self.batch_size):
+            try:
+                await self.collection.bulk_write(requests[start:start + self.batch_size], ordered=False)
+            except BulkWriteError as e:
+                errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY_ERROR]
+                if errors:
+                    raise
+                logging.info(f'Guild {guild_id}: すでに登録済みの{len(e.details["writeErrors"])}件をスキップしました')
+
+
+class CachedGuildDict:
+    def __init__(self, entries, version):
+        self.entries = entries  # entry_id -> {'word', 'pronunciation', 'user', 'time'}
+        self.matcher = DictMatcher(entries)
+        self.version = version
+        self.checked = time.monotonic()
+
+
+class GuildDictCache:
+    # サーバー辞書とコンパイル済みの置き換え器を、件数上限付きのLRUで保持する
+    # 空の辞書も「登録なし」としてキャッシュする。他のプロセスでの変更は版番号の change stream で知り、
+    # change stream が使えない場合は一定時間ごとに版番号だけを確認する
+
+    def __init__(self, store, max_guilds=1000, check_interval=30.0):
+        self.store = store
+        self.max_guilds = max_guilds
+        self.check_interval = check_interval
+        self.guilds = OrderedDict()  # guild_id(int) -> CachedGuildDict
+        self.loading = {}  # guild_id -> 読み込み中のタスク
+        self.stale = set()  # 読み込み中に変更の通知が来たサーバー
+        self.watching = False  # change stream で変更を受け取れているか
+        self.watch_task = None
+        metrics.add_collector(self.collect_metrics)
+
+    @classmethod
+    def from_env(cls, store):
+        return cls(store,
+                   max_guilds=int(os.getenv('GUILD_DICT_CACHE_SIZE', '1000')),
+                   check_interval=float(os.getenv('GUILD_DICT_CHECK_INTERVAL', '30')))
+
+    async def start(self):
+        if self.watch_task is None:
+            self.watch_task = asyncio.create_task(self.watch_loop())
+
+    async def close(self):
+        if self.watch_task is not None:
+            self.watch_task.cancel()
+            self.watch_task = None
+
+    async def get(self, guild_id):
+        cached = self.guilds.get(guild_id)
+        if cached is not None:
+            self.guilds.move_to_end(guild_id)
+            now = time.monotonic()
+            if self.watching or self.check_interval <= 0 or now - cached.checked < self.check_interval:
+                return cached
+            cached.checked = now
+            if await self.store.version(guild_id) == cached.version:
+                return cached
+
+        task = self.loading.get(guild_id)
+        if task is None:
+            task = self.loading[guild_id] = asyncio.ensure_future(self.load(guild_id))
+            task.add_done_callback(lambda _: self.loading.pop(guild_id, None))
+        return await asyncio.shield(task)
+
+    async def load(self, guild_id):
+        with metrics.timer('mongo_guild_dict', guild=guild_id):
+            # 版番号を先に読むことで、読み込み中の変更は次の確認で必ず気付ける
+            version = await self.store.version(guild_id)
+            entries = await self.store.load(guild_id)
+        if guild_id in self.stale:
+            # 読み込んだ内容がすでに古い可能性があるため、今回だけ使ってキャッシュしない
+            self.stale.discard(guild_id)
+            return CachedGuildDict(entries, version)
+        return self.put(guild_id, entries, version)
+
+    def put(self, guild_id, entries, version=0):
+        cached = self.guilds[guild_id] = CachedGuildDict(entries, version)
+        self.guilds.move_to_end(guild_id)
+        while len(self.guilds) > self.max_guilds:
+            self.guilds.popitem(last=False)
+        return cached
+
+    def invalidate(self, guild_id):
+        self.guilds.pop(guild_id, None)
+        if guild_id in self.loading:
+            self.stale.add(guild_id)
+
+    async def add(self, guild_id, entry_id, entry):
+        cached = await self.get(guild_id)
+        cached.entries[entry_id] = entry
+        cached.matcher.add(entry_id, entry.get('word'), entry.get('pronunciation'))
+        await self.store.add(guild_id, entry_id, entry)
+        await self._written(guild_id, cached)
+
+    async def remove(self, guild_id, entry_id):
+        cached = await self.get(guild_id)
+        cached.entries.pop(entry_id, None)
+        cached.matcher.remove(entry_id)
+        await self.store.remove(guild_id, entry_id)
+        await self._written(guild_id, cached)
+
+    async def bulk_import(self, guild_id, pairs, user, new_entry_id):
+        count = await self.store.bulk_import(guild_id, pairs, user, new_entry_id)
+        await self.store.bump(guild_id)
+        # 次に使うときにDBから読み直す
+        self.invalidate(guild_id)
+        return count
+
+    async def _written(self, guild_id, cached):
+        version = await self.store.bump(guild_id)
+        # 間に他のプロセスの書き込みがあれば、手元の内容は古いので読み直す
+        if version != cached.version + 1:
+            self.invalidate(guild_id)
+        cached.version = version
+
+    async def watch_loop(self):
+        resume_token = None
+        delay = 1.0
+        while True:
+            try:
+                async with self.store.versions.watch(resume_after=resume_token) as stream:
+                    if not self.watching:
+                        # 受け取れていなかった間の変更は分からないため、手元の辞書をすべて読み直す
+                        self.guilds.clear()
+                    self.watching = True
+                    delay = 1.0
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        self._on_change(change)
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                self.watching = False
+                if e.code in CHANGE_STREAM_UNSUPPORTED_ERRORS:
+                    logging.info('MongoDBが change stream に対応していないため、辞書の更新は版番号を定期的に確認して反映します')
+                    return
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    resume_token = None
+                logging.warning(f'辞書の change stream が切断されました: {e}')
+            except Exception as e:
+                self.watching = False
+                logging.warning(f'辞書の change stream が切断されました: {e}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+    def _on_change(self, change):
+        guild_id = change.get('documentKey', {}).get('_id')
+        if guild_id is None:
+            return
+        # 挿入は書き込んだドキュメント、更新は変更した項目から、どのプロセスの書き込みかを見る
+        if change.get('operationType') == 'insert':
+            writer = change.get('fullDocument', {}).get('writer')
+        else:
+            writer = change.get('updateDescription', {}).get('updatedFields', {}).get('writer')
+        if writer and writer.startswith(self.store.token + ':'):
+            return
+        self.invalidate(guild_id)
+
+    def collect_metrics(self):
+        return [('guild_dict_cache_entries', {}, len(self.guilds))]
+
+
+def parse_dict_file(filename, data):
+    # CSV（単語,読み）または JSON（[{"word", "pronunciation"}] か {単語: 読み}）から (単語, 読み) の並びを返す
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json'):
+        loaded = json.loads(text)
+        if isinstance(loaded, dict):
+            return [(str(word), str(pronunciation)) for word, pronunciation in loaded.items()]
+        return [(str(item.get('word', '')), str(item.get('pronunciation', '')))
+                for item in loaded if isinstance(item, dict)]
+
+    pairs = []
+    for row in csv.reader(io.StringIO(text)):
+        if len(row) < 2:
+            continue
+        word, pronunciation = row[0].strip(), row[1].strip()
+        if not pairs and (word, pronunciation) == ('word', 'pronunciation'):
+            continue  # 見出し行
+        pairs.append((word, pronunciation))
+    return pairs
+
+
+def format_dict_file(custom_dict, file_format):
+    entries = [entry for entry in custom_dict.values() if isinstance(entry, dict)]
+    if file_format == 'json':
+        return json.dumps([{'word': entry.get('word'), 'pronunciation': entry.get('pronunciation')}
+                           for entry in entries], ensure_ascii=False, indent=1).encode('utf-8')
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['word', 'pronunciation', 'user', 'time'])
+    for entry in entries:
+        writer.writerow([entry.get('word'), entry.get('pronunciation'), entry.get('user'), entry.get('time')])
+    # Excelで文字化けしないようBOM付きにする
+    return output.getvalue().encode('utf-8-sig')
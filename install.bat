@@ -4,6 +4,8 @@ REM Install Python packages using pip
 pip install -U discord.py[voice]
 pip install aiohttp
 pip install pymongo
+pip install motor
+pip install numpy
 pip install python-dotenv
 
 REM Install FFmpeg using winget
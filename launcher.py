@@ -0,0 +1,156 @@
+import os
+import sys
+import signal
+import asyncio
+import logging
+import aiohttp
+from dotenv import load_dotenv
+
+logging.basicConfig(level=logging.INFO)
+
+# 環境変数をロード
+load_dotenv()
+
+# シャードをいくつかのグループに分け、グループごとに main.py を別プロセスで起動する
+# （ゲートウェイの受信・音声のエンコード・合成の待ち合わせを複数のCPUコアに分散する）
+DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
+SHARD_COUNT = os.getenv('SHARD_COUNT', '')  # 空ならDiscordの推奨数
+SHARD_PROCESSES = int(os.getenv('SHARD_PROCESSES') or 0) or os.cpu_count() or 1
+# エンジン1台あたりの同時合成数（全プロセスの合計）。プロセスごとに分けて渡す
+VOICEVOX_MAX_INFLIGHT = int(os.getenv('VOICEVOX_MAX_INFLIGHT') or 2)
+# 異常終了したプロセスを再起動するまでの秒数（連続で落ちるたびに倍、上限あり）
+RESTART_DELAY = 5.0
+RESTART_DELAY_MAX = 300.0
+# これより長く動いていれば、再起動の待ち時間を初期値に戻す
+STABLE_SECONDS = 600.0
+# 停止を指示してから、終了処理を待って強制終了するまでの秒数
+STOP_TIMEOUT = 30.0
+
+
+async def fetch_gateway_info(token):
+    # 推奨シャード数と、同時にIDENTIFYできる数を取得する
+    async with aiohttp.ClientSession() as session:
+        async with session.get('https://discord.com/api/v10/gateway/bot',
+                               headers={'Authorization': f'Bot {token}'}) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return data['shards'], data.get('session_start_limit', {}).get('max_concurrency', 1)
+
+
+def split_shards(shard_count, processes):
+    # 連続したシャードIDをなるべく均等にプロセスへ割り当てる
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    groups = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return groups
+
+
+class ShardProcess:
+    def __init__(self, index, shard_ids, shard_count, processes):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.processes = processes
+        self.process = None
+
+    def env(self):
+        env = dict(os.environ)
+        env['SHARD_COUNT'] = str(self.shard_count)
+        env['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in self.shard_ids)
+        env['SHARD_PROCESS_INDEX'] = str(self.index)
+        # 他のプロセスで変更されたユーザー設定を定期的に読み直す
+        if not env.get('USER_SETTINGS_REFRESH_INTERVAL'):
+            env['USER_SETTINGS_REFRESH_INTERVAL'] = '60'
+        # 音声エンコードのワーカーは全プロセスの合計でCPUコア数の半分になるように分ける
+        if not env.get('AUDIO_ENCODER_WORKERS'):
+            env['AUDIO_ENCODER_WORKERS'] = str(max(1, (os.cpu_count() or 2) // 2 // self.processes))
+        # 合成の枠は各プロセスで持つため、エンジン1台あたりの合計が VOICEVOX_MAX_INFLIGHT になるように分ける
+        env['VOICEVOX_MAX_INFLIGHT'] = str(max(1, VOICEVOX_MAX_INFLIGHT // self.processes))
+        return env
+
+    async def run(self, stopping):
+        delay = RESTART_DELAY
+        loop = asyncio.get_running_loop()
+        while not stopping.is_set():
+            started = loop.time()
+            logging.info(f'プロセス{self.index}を起動します（シャード {self.shard_ids[0]}〜{self.shard_ids[-1]} / {self.shard_count}）')
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, 'main.py', env=self.env(), stdin=asyncio.subprocess.DEVNULL)
+            returncode = await self.process.wait()
+            if stopping.is_set():
+                break
+            if loop.time() - started > STABLE_SECONDS:
+                delay = RESTART_DELAY
+            logging.warning(f'プロセス{self.index}が終了しました（終了コード {returncode}）。{delay:.0f}秒後に再起動します')
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, RESTART_DELAY_MAX)
+
+    def terminate(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+    def kill(self):
+        if self.process is not None and self.process.returncode is None:
+            logging.warning(f'プロセス{self.index}が{STOP_TIMEOUT:.0f}秒以内に終了しなかったため、強制終了します')
+            self.process.kill()
+
+
+async def main():
+    if SHARD_COUNT:
+        shard_count, max_concurrency = int(SHARD_COUNT), 1
+    else:
+        shard_count, max_concurrency = await fetch_gateway_info(DISCORD_TOKEN)
+    groups = split_shards(shard_count, SHARD_PROCESSES)
+    logging.info(f'{shard_count}シャードを{len(groups)}プロセスで起動します')
+    if VOICEVOX_MAX_INFLIGHT < len(groups):
+        logging.warning(f'VOICEVOX_MAX_INFLIGHT({VOICEVOX_MAX_INFLIGHT})がプロセス数より少ないため、'
+                        f'エンジン1台あたり最大{len(groups)}件まで同時に合成します')
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except NotImplementedError:
+            pass  # Windows では Ctrl+C の KeyboardInterrupt で止める
+
+    shard_processes = [ShardProcess(i, shard_ids, shard_count, len(groups)) for i, shard_ids in enumerate(groups)]
+    tasks = []
+    try:
+        for shard_process in shard_processes:
+            tasks.append(asyncio.create_task(shard_process.run(stopping)))
+            # IDENTIFY は5秒に max_concurrency 回までのため、プロセスの起動をずらす
+            try:
+                await asyncio.wait_for(stopping.wait(),
+                                       timeout=5.0 * len(shard_process.shard_ids) / max_concurrency)
+            except asyncio.TimeoutError:
+                pass
+        await stopping.wait()
+    finally:
+        stopping.set()
+        for shard_process in shard_processes:
+            shard_process.terminate()
+        # 各プロセスはユーザー設定の書き込みなどの終了処理を済ませてから終わる
+        _, pending = await asyncio.wait(tasks, timeout=STOP_TIMEOUT) if tasks else (set(), set())
+        if pending:
+            for shard_process in shard_processes:
+                shard_process.kill()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    if not DISCORD_TOKEN:
+        print("トークンが設定されていません。先に main.py を起動するか、.env に DISCORD_TOKEN を設定してください。")
+    else:
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
@@ -3,8 +3,18 @@ from dotenv import load_dotenv
 import os
 import discord
 import asyncio
+import signal
+import sys
 import glob
+import json
+import hashlib
 import traceback
+from voicevox_client import VoiceVoxClient
+from user_settings_store import UserSettingsStore
+from guild_dict_store import GuildDictStore, GuildDictCache
+from audio_encoder import AudioEncoder
+from voice_session_store import VoiceSessionStore
+from metrics import metrics, METRICS_HOST, METRICS_PORT
 
 # 環境変数のロード
 load_dotenv()
@@ -19,6 +29,16 @@ if not DISCORD_TOKEN:
     with open('.env', 'a') as env_file:
         env_file.write(f'\nDISCORD_TOKEN={DISCORD_TOKEN}\n')
 
+# シャード設定（launcher.py から起動した場合はプロセスごとに担当するシャードが渡される）
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+SHARD_PROCESS_INDEX = int(os.getenv('SHARD_PROCESS_INDEX', '0'))
+
+# コマンド定義のハッシュを保存するファイル（変更がなければ起動時の同期を省く）
+COMMAND_SYNC_STATE = os.getenv('COMMAND_SYNC_STATE', '.command_sync.json')
+# 定義が変わっていなくても同期する（起動時の引数 --force-sync でも指定できる）
+COMMAND_SYNC_FORCE = os.getenv('COMMAND_SYNC_FORCE', '').lower() in ('1', 'true', 'yes') or '--force-sync' in sys.argv
+
 # Discordのインテント設定
 intents = discord.Intents.default()
 intents.guilds = True
@@ -26,8 +46,37 @@ intents.members = True
 intents.message_content = True
 intents.voice_states = True
 
-class MyBot(commands.Bot): 
+class MyBot(commands.AutoShardedBot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 全てのCogで共有するVoiceVoxクライアント
+        self.voicevox = VoiceVoxClient.from_env()
+        # ユーザーごとの話者・音声設定（メモリ上で参照し、DBへは後からまとめて書き込む）
+        self.user_settings = UserSettingsStore.from_env()
+        # サーバー辞書（1単語1ドキュメントで保存）
+        self.guild_dict_store = GuildDictStore.from_env()
+        self.guild_dicts = GuildDictCache.from_env(self.guild_dict_store)
+        # 合成した音声をOpusフレームに変換するワーカープロセス
+        self.audio_encoder = AudioEncoder.from_env()
+        # 読み上げ中のサーバーとチャンネル（再起動後に接続し直す）
+        self.voice_sessions = VoiceSessionStore.from_env()
+
+    @property
+    def is_primary(self):
+        # コマンドの同期など、全プロセスで1回だけ行う処理はシャード0を持つプロセスが担当する
+        return self.shard_ids is None or 0 in self.shard_ids
+
     async def setup_hook(self):
+        await self.voicevox.start()
+        await self.user_settings.start()
+        await self.guild_dict_store.start()
+        await self.guild_dicts.start()
+        await self.audio_encoder.start()
+        # METRICS_PORT を設定したときだけ /metrics を公開する
+        if METRICS_PORT:
+            # 複数プロセスで起動した場合はプロセスごとにポートをずらす
+            await metrics.start_server(METRICS_HOST, int(METRICS_PORT) + SHARD_PROCESS_INDEX)
+
         for filepath in glob.glob(os.path.join("cogs", "*.py")):
             if os.path.basename(filepath) == "__init__.py": 
                 continue
@@ -40,15 +89,72 @@ class MyBot(commands.Bot):
                 print(f"{cog}の読み込みに失敗しました: {e}")
                 traceback.print_exc() 
 
-        await self.tree.sync(guild=None)  
+        if self.is_primary:
+            await self.sync_commands(force=COMMAND_SYNC_FORCE)
+
+    def command_tree_hash(self):
+        # Discordへ送る内容と同じ形に変換してハッシュを取る
+        payload = [command.to_dict(self.tree) for command in self.tree.get_commands()]
+        payload.sort(key=lambda command: (command.get('type', 1), command['name']))
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
 
-bot = MyBot(command_prefix='!m', intents=intents, heartbeat_timeout=60, case_insensitive=True)
+    async def sync_commands(self, force=False):
+        # 前回同期したときからコマンド定義が変わった場合のみ同期する。同期したら True を返す
+        tree_hash = self.command_tree_hash()
+        try:
+            with open(COMMAND_SYNC_STATE, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        application_id = str(self.application_id)
+        if not force and state.get(application_id) == tree_hash:
+            print("コマンド定義に変更がないため、同期を省略しました。")
+            return False
+
+        await self.tree.sync(guild=None)
+        state[application_id] = tree_hash
+        try:
+            with open(COMMAND_SYNC_STATE, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+        except OSError as e:
+            print(f"コマンド同期の状態を保存できませんでした: {e}")
+        print("コマンドを同期しました。")
+        return True
+
+    async def close(self):
+        await super().close()
+        await self.voicevox.close()
+        await metrics.stop_server()
+        await self.guild_dicts.close()
+        await self.audio_encoder.close()
+        try:
+            await self.user_settings.close()
+        except Exception as e:
+            print(f"ユーザー設定の保存に失敗しました: {e}")
 
 async def main():
+    # Windows では音声エンコードのワーカープロセスがこのファイルを読み込み直すため、Botはここで作る
+    bot = MyBot(command_prefix='!m', intents=intents, heartbeat_timeout=60, case_insensitive=True,
+                shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+    # launcher.py は SIGTERM で停止させるため、終了処理（ユーザー設定の書き込みなど）を行ってから終わる
+    closing = None
+
+    def request_close():
+        nonlocal closing
+        if closing is None:
+            closing = asyncio.create_task(bot.close())
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, request_close)
+    except (NotImplementedError, AttributeError):
+        pass  # Windows では使えない
     try:
         await bot.start(DISCORD_TOKEN)  # 環境変数またはコンソールから取得したトークンを使用
     finally:
-        await bot.close()
+        if closing is not None:
+            await closing
+        else:
+            await bot.close()
 
 if __name__ == '__main__':
     # トークンが空白かどうかの検証
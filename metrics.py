@@ -0,0 +1,170 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+from aiohttp import web
+from dotenv import load_dotenv
+
+# 環境変数をロード
+load_dotenv()
+
+# ヒストグラムの区切り（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        # 区切りの中で線形補間したおおよその値
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(BUCKETS, self.counts):
+            if cumulative + count >= target and count:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (target - cumulative) / count
+            cumulative += count
+            if bound != float('inf'):
+                lower = bound
+        return lower
+
+
+class Metrics:
+    # 読み上げの各段階の所要時間（ヒストグラム）と件数（カウンター）を、サーバー・エンジンごとに集計する
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> 値
+        self.collectors = []  # 出力時に呼ばれ、(name, labels, 値) のリストを返す関数
+        self.runner = None
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        key = (name, self._labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def aggregate(self, name, **labels):
+        # 指定したラベルに一致するヒストグラムをまとめる（ラベル省略時は全体）
+        wanted = set(self._labels(labels))
+        total = Histogram()
+        for (hist_name, hist_labels), histogram in self.histograms.items():
+            if hist_name == name and wanted.issubset(hist_labels):
+                total.merge(histogram)
+        return total
+
+    def counter_total(self, name, **labels):
+        wanted = set(self._labels(labels))
+        return sum(value for (counter_name, counter_labels), value in self.counters.items()
+                   if counter_name == name and wanted.issubset(counter_labels))
+
+    def stage_names(self):
+        return sorted({name for name, _ in self.histograms})
+
+    def render(self):
+        # Prometheus のテキスト形式で出力する
+        lines = []
+        for name in self.stage_names():
+            lines.append(f'# TYPE yomiage_{name}_seconds histogram')
+            for (hist_name, labels), histogram in sorted(self.histograms.items()):
+                if hist_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'yomiage_{name}_seconds_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'yomiage_{name}_seconds_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'yomiage_{name}_seconds_count{_format_labels(labels)} {histogram.count}')
+
+        counter_names = sorted({name for name, _ in self.counters})
+        for name in counter_names:
+            lines.append(f'# TYPE yomiage_{name}_total counter')
+            for (counter_name, labels), value in sorted(self.counters.items()):
+                if counter_name == name:
+                    lines.append(f'yomiage_{name}_total{_format_labels(labels)} {value}')
+
+        gauges = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges.setdefault(name, []).append((self._labels(labels), value))
+            except Exception as e:
+                logging.error(f'メトリクスの収集に失敗しました: {e}')
+        for name, values in sorted(gauges.items()):
+            lines.append(f'# TYPE yomiage_{name} gauge')
+            for labels, value in values:
+                lines.append(f'yomiage_{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    async def start_server(self, host, port):
+        # ローカル用の /metrics エンドポイント
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logging.info(f'メトリクスを http://{host}:{port}/metrics で公開しています')
+
+    async def stop_server(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    formatted = ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+    return '{' + formatted + '}'
+
+
+# Bot全体で共有するメトリクス
+metrics = Metrics()
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT', '')
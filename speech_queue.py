@@ -0,0 +1,146 @@
+import os
+import re
+import time
+from collections import deque
+from dotenv import load_dotenv
+
+# 環境変数をロード
+load_dotenv()
+
+# 2つ目以降の文をまとめて合成する目安の文字数
+SYNTHESIS_CHUNK_LENGTH = int(os.getenv('SYNTHESIS_CHUNK_LENGTH', '80'))
+# 通常レーンに溜められる最大件数と、合成前に読み捨てるまでの秒数
+AUDIO_QUEUE_MAX_BACKLOG = int(os.getenv('AUDIO_QUEUE_MAX_BACKLOG', '50'))
+AUDIO_QUEUE_TTL = float(os.getenv('AUDIO_QUEUE_TTL', '60'))
+# 待ちがこの件数を超えたら、1件ごとに話速を STEP 倍ずつ上げる（上限 CEILING、STEP=0で無効）
+ADAPTIVE_SPEED_START = int(os.getenv('ADAPTIVE_SPEED_START', '3'))
+ADAPTIVE_SPEED_STEP = float(os.getenv('ADAPTIVE_SPEED_STEP', '0.05'))
+ADAPTIVE_SPEED_CEILING = float(os.getenv('ADAPTIVE_SPEED_CEILING', '1.6'))
+
+SENTENCE_PATTERN = re.compile(r'.+?(?:[。！？!?\n]+|$)', re.S)
+
+
+def split_sentences(text):
+    # 句読点・改行で区切り、最初の1文はすぐ再生できるよう単独で、以降は短い文をまとめて返す
+    sentences = [s.strip() for s in SENTENCE_PATTERN.findall(text)]
+    sentences = [s for s in sentences if s]
+    if not sentences:
+        return []
+
+    chunks = [sentences[0]]
+    current = ''
+    for sentence in sentences[1:]:
+        if current and len(current) + len(sentence) > SYNTHESIS_CHUNK_LENGTH:
+            chunks.append(current)
+            current = ''
+        current += sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def adaptive_speed(speed, backlog):
+    # ユーザーの話速に、待ち件数に応じた倍率を掛ける。待ちが減れば元の話速に戻る
+    if ADAPTIVE_SPEED_STEP <= 0 or backlog <= ADAPTIVE_SPEED_START:
+        return speed
+    base = 1.0 if speed is None else speed
+    scaled = base * (1.0 + ADAPTIVE_SPEED_STEP * (backlog - ADAPTIVE_SPEED_START))
+    # ユーザーが上限より速く設定している場合は、その速さのまま
+    return round(max(base, min(scaled, ADAPTIVE_SPEED_CEILING)), 2)
+
+
+class SpeechEntry:
+    def __init__(self, message, text, chunks=None):
+        self.message = message
+        self.text = text  # 辞書置き換え済みのテキスト
+        self.chunks = split_sentences(text) if chunks is None else chunks
+        self.voice = None  # (speaker_id, intensity, pitch, speed)。ユーザー設定を読み込むまでは None
+        self.index = 0  # 次に再生する文の位置
+        self.tasks = {}  # 文の位置 -> 先読み合成のタスク
+        self.cancelled = False  # 破棄されて合成を止めたか
+        self.created = time.monotonic()
+
+    @classmethod
+    def merge(cls, entries):
+        # 文末に区切りがなければ「。」を挟み、続けて読んでも聞き分けられるようにする
+        text = ''
+        for entry in entries:
+            chunk = entry.chunks[0]
+            text += chunk if chunk.endswith(('。', '！', '？', '!', '?')) else chunk + '。'
+        merged = cls(entries[0].message, text, chunks=[text])
+        merged.voice = entries[0].voice
+        merged.created = entries[0].created
+        return merged
+
+    def cancel(self):
+        self.cancelled = True
+        for task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+
+
+class SpeechQueue:
+    # サーバーごとの読み上げキュー。要素は (message_type, content) で、
+    # システム・入室メッセージ用の優先レーンを通常のチャットより先に読む
+
+    def __init__(self, max_backlog=AUDIO_QUEUE_MAX_BACKLOG, ttl=AUDIO_QUEUE_TTL):
+        self.priority = deque()
+        self.normal = deque()
+        self.max_backlog = max_backlog
+        self.ttl = ttl
+
+    def __len__(self):
+        return len(self.priority) + len(self.normal)
+
+    def __iter__(self):
+        yield from self.priority
+        yield from self.normal
+
+    def lanes(self):
+        return (self.priority, self.normal)
+
+    def head_lane(self):
+        return self.priority if self.priority else self.normal
+
+    def append(self, item, priority=False):
+        # 上限を超えたら、まだ読み始めていない一番古いものから捨てる。捨てた要素を返す
+        lane = self.priority if priority else self.normal
+        lane.append(item)
+        dropped = []
+        while self.max_backlog > 0 and len(lane) > self.max_backlog:
+            position = next((i for i, (message_type, content) in enumerate(lane)
+                             if message_type != 'text' or content.index == 0), 0)
+            dropped.append(lane[position])
+            del lane[position]
+        return dropped
+
+    def expire(self, now=None):
+        # 通常レーンの、合成を始めていないまま TTL を過ぎたチャットを捨てる。捨てた要素を返す
+        if self.ttl <= 0 or not self.normal:
+            return []
+        now = time.monotonic() if now is None else now
+        dropped = []
+        kept = []
+        while self.normal:
+            message_type, content = self.normal[0]
+            if message_type == 'text' and not content.tasks:
+                if now - content.created <= self.ttl:
+                    break  # 以降はこれより新しい
+                dropped.append(self.normal.popleft())
+                continue
+            kept.append(self.normal.popleft())
+        self.normal.extendleft(reversed(kept))
+        return dropped
+
+    def remove(self, item):
+        for lane in self.lanes():
+            if item in lane:
+                lane.remove(item)
+                return True
+        return False
+
+    def clear(self):
+        items = list(self)
+        self.priority.clear()
+        self.normal.clear()
+        return items
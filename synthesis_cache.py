@@ -0,0 +1,151 @@
+import os
+import asyncio
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# 環境変数をロード
+load_dotenv()
+
+
+class SynthesisCache:
+    # 合成済みWAVのキャッシュ。メモリ上のLRUと、再起動後も残る任意のディスク層を持つ
+
+    def __init__(self, max_bytes, disk_dir=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> WAVバイト列
+        self.size = 0
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_entries = OrderedDict()  # ファイル名 -> サイズ（古い順）
+        self.disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    @classmethod
+    def from_env(cls):
+        max_mb = float(os.getenv('SYNTHESIS_CACHE_MB', '64'))
+        if max_mb <= 0:
+            return None
+        return cls(
+            int(max_mb * 1024 * 1024),
+            disk_dir=os.getenv('SYNTHESIS_CACHE_DIR') or None,
+            max_disk_bytes=int(float(os.getenv('SYNTHESIS_CACHE_DISK_MB', '512')) * 1024 * 1024),
+        )
+
+    @staticmethod
+    def make_key(text, speaker_id, intensity=None, pitch=None, speed=None):
+        # 全角半角や前後・連続する空白の違いは同じ音声として扱う
+        normalized = ' '.join(unicodedata.normalize('NFKC', text).split())
+        return (normalized, speaker_id, intensity, pitch, speed)
+
+    async def get(self, key):
+        audio = self.entries.get(key)
+        if audio is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return audio
+
+        if self.disk_dir:
+            filename = self._filename(key)
+            if filename in self.disk_entries:
+                audio = await asyncio.to_thread(self._read_file, filename)
+                if audio is not None:
+                    self.disk_entries.move_to_end(filename)
+                    self.disk_hits += 1
+                    self._put_memory(key, audio)
+                    return audio
+                self.disk_size -= self.disk_entries.pop(filename, 0)
+
+        self.misses += 1
+        return None
+
+    async def put(self, key, audio):
+        self._put_memory(key, audio)
+        if self.disk_dir and self.max_disk_bytes > 0:
+            filename = self._filename(key)
+            if filename not in self.disk_entries and await asyncio.to_thread(self._write_file, filename, audio):
+                self.disk_entries[filename] = len(audio)
+                self.disk_size += len(audio)
+                evicted = []
+                while self.disk_size > self.max_disk_bytes and self.disk_entries:
+                    old_name, old_size = self.disk_entries.popitem(last=False)
+                    self.disk_size -= old_size
+                    evicted.append(old_name)
+                if evicted:
+                    await asyncio.to_thread(self._remove_files, evicted)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'disk_entries': len(self.disk_entries),
+            'disk_bytes': self.disk_size,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def _put_memory(self, key, audio):
+        if len(audio) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = audio
+        self.size += len(audio)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _filename(self, key):
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest() + '.wav'
+
+    def _scan_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.wav'):
+                continue
+            stat = os.stat(os.path.join(self.disk_dir, name))
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.disk_entries[name] = size
+            self.disk_size += size
+
+    def _read_file(self, filename):
+        try:
+            with open(os.path.join(self.disk_dir, filename), 'rb') as f:
+                return f.read()
+        except OSError as e:
+            logging.warning(f'キャッシュファイルの読み込みに失敗しました: {e}')
+            return None
+
+    def _write_file(self, filename, audio):
+        path = os.path.join(self.disk_dir, filename)
+        try:
+            # 書き込み途中のファイルを読まないよう、一時ファイルから置き換える
+            # （複数プロセスで同じディレクトリを共有しても衝突しないようプロセスIDを付ける）
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f'キャッシュファイルの書き込みに失敗しました: {e}')
+            return False
+        return True
+
+    def _remove_files(self, filenames):
+        for filename in filenames:
+            try:
+                os.remove(os.path.join(self.disk_dir, filename))
+            except OSError:
+                pass
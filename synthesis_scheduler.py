@@ -0,0 +1,71 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+
+class FairScheduler:
+    # 合成の実行枠を、サーバーごとの待ち行列から順番に渡す（重みを設定したサーバーは1巡でその回数まで）
+    # 1つのサーバーに大量のメッセージが来ても、他のサーバーの待ち時間が伸びないようにする
+
+    def __init__(self, capacity, weights=None):
+        self.capacity = capacity  # 同時に実行できる数を返す関数
+        self.weights = weights or {}  # key -> 1巡で実行できる回数
+        self.waiting = OrderedDict()  # key -> 枠を待っている Future（先頭のサーバーから順に渡す）
+        self.credits = {}  # key -> この巡で残っている回数
+        self.running = 0
+
+    def pending(self):
+        return sum(len(queue) for queue in self.waiting.values())
+
+    @asynccontextmanager
+    async def slot(self, key=None):
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, key=None):
+        if not self.waiting and self.running < self.capacity():
+            self.running += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(key, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 枠を受け取った直後にキャンセルされた場合は、次の待ちに回す
+                self.release()
+            else:
+                queue = self.waiting.get(key)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self.waiting[key]
+                        self.credits.pop(key, None)
+            raise
+
+    def release(self):
+        self.running -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        while self.waiting and self.running < self.capacity():
+            key, queue = next(iter(self.waiting.items()))
+            future = queue.popleft()
+            credits = self.credits.get(key, self.weights.get(key, 1)) - 1
+            if not queue:
+                del self.waiting[key]
+                self.credits.pop(key, None)
+            elif credits <= 0:
+                # この巡の分を使い切ったので、次のサーバーに回す
+                self.waiting.move_to_end(key)
+                self.credits.pop(key, None)
+            else:
+                self.credits[key] = credits
+            if future.done():
+                continue
+            self.running += 1
+            future.set_result(None)
@@ -0,0 +1,43 @@
+import re
+
+# 読み上げ用の置き換え文字列
+URL_PLACEHOLDER = 'URL省略'
+NUMBER_PLACEHOLDER = 'たくさんの数字'
+MENTION_PLACEHOLDER = 'メンション'
+# これ以上の桁数（先頭の0を除く）の数字は読み上げずに置き換える（1億以上）
+LONG_NUMBER_DIGITS = 9
+
+# URL・メンション・カスタム絵文字・長い数字を1つの正規表現にまとめ、1回の走査で置き換える
+TOKEN_PATTERN = re.compile(
+    r'(?P<url>https?://\S+)'
+    r'|<(?:@!?|@&|#)(?P<mention_id>\d+)>'
+    r'|<a?:(?P<emoji>\w+):\d+>'
+    r'|(?P<number>\d{%d,})' % LONG_NUMBER_DIGITS
+)
+# 改行は文の区切りとして使うため残し、連続する空白だけをまとめる
+SPACE_PATTERN = re.compile(r'[^\S\n]+')
+
+
+def normalize_message(content, names=None):
+    # 読み上げるテキストを返す。読み上げるものが残らなければ None
+    # names はメンションのID（文字列）から表示名への辞書
+    if not content:
+        return None
+
+    def substitute(match):
+        kind = match.lastgroup
+        if kind == 'url':
+            return URL_PLACEHOLDER
+        if kind == 'mention_id':
+            name = names.get(match.group('mention_id')) if names else None
+            return name if name else MENTION_PLACEHOLDER
+        if kind == 'emoji':
+            return match.group('emoji')
+        digits = match.group('number')
+        if len(digits.lstrip('0')) >= LONG_NUMBER_DIGITS:
+            return NUMBER_PLACEHOLDER
+        return digits
+
+    text = TOKEN_PATTERN.sub(substitute, content)
+    text = SPACE_PATTERN.sub(' ', text).strip()
+    return text or None
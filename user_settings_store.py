@@ -0,0 +1,179 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from dotenv import load_dotenv
+from metrics import metrics
+
+# 環境変数をロード
+load_dotenv()
+
+DEFAULT_INTENSITY = 1.0
+DEFAULT_PITCH = 0
+DEFAULT_SPEED = 1.0
+# 移行時に1回の bulk_write にまとめる件数
+MIGRATE_BATCH_SIZE = 1000
+# 重複キーのエラーコード（複数プロセスで同時に移行した場合など）
+DUPLICATE_KEY_ERROR = 11000
+# 移行が終わったことを記録するドキュメントのID（migrations コレクション）
+MIGRATION_ID = 'user_settings_per_user'
+
+
+class UserSettingsStore:
+    # ユーザーごとの話者・音声設定を1ユーザー1ドキュメントで保存する
+    # 読み出しは使われたユーザーだけを上限付きのLRUに載せ、書き込みは変更した項目だけを後からまとめて行う
+
+    def __init__(self, collection, flush_interval=5.0, refresh_interval=0.0, cache_size=10000):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        # 複数プロセスで動かす場合、他のプロセスで変更された設定を読み直す間隔（0で読み直さない）
+        self.refresh_interval = refresh_interval
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # user_id -> (設定, 読み込んだ時刻)
+        self.pending = {}  # user_id -> まだ書き込んでいない項目
+        self.flushing = {}  # user_id -> 書き込み中の項目
+        self.loading = {}  # user_id -> 読み込み中のタスク（同じユーザーを同時に何度も読まない）
+        self.flush_task = None
+        metrics.add_collector(self.collect_metrics)
+
+    @classmethod
+    def from_env(cls):
+        mongo_client = AsyncIOMotorClient(os.getenv('MONGODB_URL'))
+        collection = mongo_client['discord_bot_db']['user_settings']
+        return cls(collection,
+                   flush_interval=float(os.getenv('USER_SETTINGS_FLUSH_INTERVAL', '5')),
+                   refresh_interval=float(os.getenv('USER_SETTINGS_REFRESH_INTERVAL') or 0),
+                   cache_size=int(os.getenv('USER_SETTINGS_CACHE_SIZE', '10000')))
+
+    async def start(self):
+        await self.migrate()
+        await self.collection.create_index([('user_id', ASCENDING)], unique=True, sparse=True)
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_loop())
+
+    async def migrate(self):
+        # 以前は全ユーザーの話者IDを1つのドキュメントにまとめていたため、ユーザーごとのドキュメントへ移す
+        # コレクション全体を調べるため、一度終わったら記録を残して次回からは省く
+        migrations = self.collection.database['migrations']
+        if await migrations.find_one({'_id': MIGRATION_ID}) is not None:
+            return
+        # 以前の保存は update_one({}) だったため、先に音声設定を保存したユーザーのドキュメントに
+        # 話者IDがまとめて書き込まれている場合もある（キーがユーザーIDの数字）
+        legacy_query = {'$or': [
+            {'user_id': {'$exists': False}},
+            {'$expr': {'$anyElementTrue': [{'$map': {
+                'input': {'$objectToArray': '$$ROOT'},
+                'in': {'$regexMatch': {'input': '$$this.k', 'regex': r'^\d+$'}},
+            }}]}},
+        ]}
+        migrated = 0
+        async for legacy in self.collection.find(legacy_query):
+            has_owner = 'user_id' in legacy
+            speakers = {key: value for key, value in legacy.items()
+                        if key != '_id' and (key.isdigit() or not has_owner)}
+            requests = [UpdateOne({'user_id': user_id}, {'$set': {'speaker_id': speaker_id}}, upsert=True)
+                        for user_id, speaker_id in speakers.items()]
+            for start in range(0, len(requests), MIGRATE_BATCH_SIZE):
+                try:
+                    await self.collection.bulk_write(requests[start:start + MIGRATE_BATCH_SIZE], ordered=False)
+                except BulkWriteError as e:
+                    if any(error.get('code') != DUPLICATE_KEY_ERROR for error in e.details.get('writeErrors', [])):
+                        raise
+            if has_owner:
+                await self.collection.update_one({'_id': legacy['_id']},
+                                                 {'$unset': {user_id: '' for user_id in speakers}})
+            else:
+                await self.collection.delete_one({'_id': legacy['_id']})
+            migrated += len(requests)
+        if migrated:
+            logging.info(f'ユーザー {migrated}人分の話者設定を新しい形式に移行しました')
+        await migrations.update_one({'_id': MIGRATION_ID}, {'$set': {'completed': datetime.now()}}, upsert=True)
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+    async def get(self, user_id):
+        user_id = str(user_id)
+        cached = self.cache.get(user_id)
+        if cached is not None and (self.refresh_interval <= 0 or time.monotonic() - cached[1] < self.refresh_interval):
+            self.cache.move_to_end(user_id)
+            return dict(cached[0])
+
+        task = self.loading.get(user_id)
+        if task is None:
+            task = self.loading[user_id] = asyncio.ensure_future(self.load(user_id))
+            task.add_done_callback(lambda _: self.loading.pop(user_id, None))
+        return dict(await asyncio.shield(task))
+
+    async def load(self, user_id):
+        doc = await self.collection.find_one({'user_id': user_id}, {'_id': 0}) or {}
+        # 未設定のユーザーも既定値としてキャッシュし、毎回DBを引かないようにする
+        settings = {
+            'intensity': doc.get('intensity', DEFAULT_INTENSITY),
+            'pitch': doc.get('pitch', DEFAULT_PITCH),
+            'speed': doc.get('speed', DEFAULT_SPEED),
+        }
+        if doc.get('speaker_id') is not None:
+            settings['speaker_id'] = doc['speaker_id']
+        # まだDBに書き込み終えていない変更があればそちらを優先する
+        settings.update(self.flushing.get(user_id, {}))
+        settings.update(self.pending.get(user_id, {}))
+
+        self.cache[user_id] = (settings, time.monotonic())
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return settings
+
+    def update(self, user_id, fields):
+        user_id = str(user_id)
+        self.pending.setdefault(user_id, {}).update(fields)
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            cached[0].update(fields)
+
+    def set_speaker(self, user_id, speaker_id):
+        self.update(user_id, {'speaker_id': speaker_id})
+
+    def set_voice_settings(self, user_id, intensity, pitch, speed):
+        self.update(user_id, {'intensity': intensity, 'pitch': pitch, 'speed': speed})
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f'ユーザー設定の保存に失敗しました: {e}')
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        self.flushing = pending
+        try:
+            await self.collection.bulk_write([
+                UpdateOne({'user_id': user_id}, {'$set': fields}, upsert=True)
+                for user_id, fields in pending.items()
+            ], ordered=False)
+        except Exception:
+            # 失敗した分は次回の書き込みで再試行する（その間に変更された項目はそちらを優先する）
+            for user_id, fields in pending.items():
+                self.pending[user_id] = {**fields, **self.pending.get(user_id, {})}
+            raise
+        finally:
+            self.flushing = {}
+
+    def collect_metrics(self):
+        return [
+            ('user_settings_cache_entries', {}, len(self.cache)),
+            ('user_settings_pending_writes', {}, len(self.pending)),
+        ]
@@ -0,0 +1,39 @@
+import os
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient
+from dotenv import load_dotenv
+
+# 環境変数をロード
+load_dotenv()
+
+
+class VoiceSessionStore:
+    # 読み上げ中のサーバーの（ボイスチャンネル, テキストチャンネル）を保存し、再起動後に接続し直せるようにする
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    @classmethod
+    def from_env(cls):
+        mongo_client = AsyncIOMotorClient(os.getenv('MONGODB_URL'))
+        return cls(mongo_client['discord_bot_db']['voice_sessions'])
+
+    async def save(self, guild_id, voice_channel_id, text_channel_id):
+        await self.collection.update_one(
+            {'_id': guild_id},
+            {'$set': {'voice_channel_id': voice_channel_id, 'text_channel_id': text_channel_id,
+                      'updated': datetime.now()}},
+            upsert=True)
+
+    async def update_voice_channel(self, guild_id, voice_channel_id):
+        await self.collection.update_one({'_id': guild_id}, {'$set': {'voice_channel_id': voice_channel_id}})
+
+    async def remove(self, guild_id):
+        await self.collection.delete_one({'_id': guild_id})
+
+    async def load_all(self):
+        # guild_id -> (voice_channel_id, text_channel_id)
+        sessions = {}
+        async for doc in self.collection.find({}):
+            sessions[doc['_id']] = (doc.get('voice_channel_id'), doc.get('text_channel_id'))
+        return sessions
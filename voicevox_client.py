@@ -0,0 +1,317 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import aiohttp
+from dotenv import load_dotenv
+from synthesis_cache import SynthesisCache
+from synthesis_scheduler import FairScheduler
+from metrics import metrics
+
+# 環境変数をロード
+load_dotenv()
+
+
+class VoiceVoxEngine:
+    # 1台分のVoiceVoxエンジンの状態
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0  # 処理中のリクエスト数
+        self.inflight = 0  # このエンジンに割り当てた実行中の合成数（max_inflight まで）
+        self.failures = 0  # 連続失敗回数
+        self.healthy = True
+        self.loaded = set()  # 読み込み済みの話者（スタイル）ID
+        self.warmup_task = None
+
+
+class VoiceVoxClient:
+    # Bot全体で共有するVoiceVoxクライアント。コネクションプールとkeep-aliveを使い回し、
+    # 複数のエンジンに処理中リクエスト数が最も少ない順で振り分ける
+
+    def __init__(self, base_urls, pool_size=20, keepalive_timeout=30.0, timeout=15.0, retries=2, retry_backoff=0.5,
+                 cache=None, health_interval=10.0, eject_failures=3, max_inflight=2, guild_weights=None,
+                 warmup_speakers=()):
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        self.engines = [VoiceVoxEngine(url) for url in base_urls]
+        self.pool_size = pool_size  # エンジン1台あたりの同時接続数
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.cache = cache  # SynthesisCache（Noneならキャッシュしない）
+        self.health_interval = health_interval
+        self.eject_failures = eject_failures
+        # エンジン1台あたりの同時合成数（このプロセスの分）。合成はサーバーごとに順番に枠を渡して実行する
+        # launcher.py で起動した場合は、全プロセスの合計がこの値になるように分けて渡される
+        self.max_inflight = max_inflight
+        self.scheduler = FairScheduler(self.capacity, weights=guild_weights)
+        # 起動時・エンジン復帰時に読み込んでおく話者（スタイル）ID
+        self.warmup_speakers = sorted(set(warmup_speakers))
+        self.session = None
+        self.health_task = None
+        metrics.add_collector(self.collect_metrics)
+
+    @classmethod
+    def from_env(cls):
+        urls = [url.strip() for url in os.getenv('VOICEVOX_URL', 'http://localhost:50021').split(',') if url.strip()]
+        return cls(
+            urls,
+            pool_size=int(os.getenv('VOICEVOX_POOL_SIZE', '20')),
+            keepalive_timeout=float(os.getenv('VOICEVOX_KEEPALIVE', '30')),
+            timeout=float(os.getenv('VOICEVOX_TIMEOUT', '15')),
+            retries=int(os.getenv('VOICEVOX_RETRIES', '2')),
+            retry_backoff=float(os.getenv('VOICEVOX_RETRY_BACKOFF', '0.5')),
+            cache=SynthesisCache.from_env(),
+            health_interval=float(os.getenv('VOICEVOX_HEALTH_INTERVAL', '10')),
+            eject_failures=int(os.getenv('VOICEVOX_EJECT_FAILURES', '3')),
+            max_inflight=int(os.getenv('VOICEVOX_MAX_INFLIGHT', '2')),
+            guild_weights=parse_weights(os.getenv('SYNTHESIS_GUILD_WEIGHTS', '')),
+            warmup_speakers=configured_speaker_ids() if os.getenv('VOICEVOX_WARMUP', '1') != '0' else (),
+        )
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size * len(self.engines),
+                                             limit_per_host=self.pool_size,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        if self.health_task is None and self.health_interval > 0:
+            self.health_task = asyncio.create_task(self.health_loop())
+        for engine in self.engines:
+            self.start_warmup(engine)
+
+    async def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+        for engine in self.engines:
+            if engine.warmup_task is not None:
+                engine.warmup_task.cancel()
+                engine.warmup_task = None
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def capacity(self):
+        # 合成を割り当てられるエンジンの台数分の枠（話者の読み込み中のエンジンは、他になければ数える）
+        return self.max_inflight * len(self.slot_candidates())
+
+    def slot_candidates(self):
+        candidates = [e for e in self.engines if e.healthy and not self.warming(e)]
+        return candidates or [e for e in self.engines if e.healthy] or self.engines
+
+    def pick_slot_engine(self):
+        # 枠を受け取った合成を、同時合成数に余裕のあるエンジンのうち最も空いているものに割り当てる
+        candidates = self.slot_candidates()
+        available = [e for e in candidates if e.inflight < self.max_inflight]
+        return min(available or candidates, key=lambda e: (e.inflight, e.outstanding))
+
+    def collect_metrics(self):
+        values = [
+            ('synthesis_running', {}, self.scheduler.running),
+            ('synthesis_waiting', {}, self.scheduler.pending()),
+        ]
+        for engine in self.engines:
+            values.append(('voicevox_outstanding', {'endpoint': engine.url}, engine.outstanding))
+            values.append(('voicevox_inflight', {'endpoint': engine.url}, engine.inflight))
+            values.append(('voicevox_healthy', {'endpoint': engine.url}, int(engine.healthy)))
+            values.append(('voicevox_loaded_speakers', {'endpoint': engine.url}, len(engine.loaded)))
+        if self.cache is not None:
+            for name, value in self.cache.stats().items():
+                values.append((f'synthesis_cache_{name}', {}, value))
+        return values
+
+    def pick_engine(self, exclude=()):
+        # 正常なエンジンのうち、まだ試していないものから処理中リクエストが最少のものを選ぶ
+        # 話者の読み込み中のエンジンは、他に使えるエンジンがなければ使う
+        candidates = [e for e in self.engines if e.healthy and e not in exclude and not self.warming(e)]
+        if not candidates:
+            candidates = [e for e in self.engines if e.healthy and e not in exclude]
+        if not candidates:
+            candidates = [e for e in self.engines if e.healthy] or self.engines
+        return min(candidates, key=lambda e: e.outstanding)
+
+    def mark_success(self, engine):
+        engine.failures = 0
+        if not engine.healthy:
+            engine.healthy = True
+            logging.info(f'VoiceVoxエンジン {engine.url} を復帰させました')
+            # 再起動していればモデルが読み込まれていないため、もう一度読み込んでおく
+            self.start_warmup(engine)
+
+    def mark_failure(self, engine):
+        engine.failures += 1
+        if engine.healthy and engine.failures >= self.eject_failures:
+            engine.healthy = False
+            engine.loaded.clear()
+            logging.warning(f'VoiceVoxエンジン {engine.url} を切り離しました（連続{engine.failures}回失敗）')
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*(self.probe(engine) for engine in self.engines))
+
+    async def probe(self, engine):
+        timeout = aiohttp.ClientTimeout(total=5)
+        try:
+            async with self.session.get(f"{engine.url}/version", timeout=timeout) as resp:
+                resp.raise_for_status()
+            self.mark_success(engine)
+            # 切り離されるより早く再起動した場合もモデルが消えているため、読み込み済みの話者を1つ確かめる
+            if engine.loaded and not self.warming(engine):
+                speaker_id = next(iter(engine.loaded))
+                async with self.session.get(f"{engine.url}/is_initialized_speaker",
+                                            params={'speaker': speaker_id}, timeout=timeout) as resp:
+                    resp.raise_for_status()
+                    initialized = await resp.json()
+                if not initialized:
+                    logging.info(f'VoiceVoxエンジン {engine.url} が再起動したため、話者を読み込み直します')
+                    engine.loaded.clear()
+                    self.start_warmup(engine)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.mark_failure(engine)
+
+    def warming(self, engine):
+        return engine.warmup_task is not None and not engine.warmup_task.done()
+
+    def start_warmup(self, engine):
+        if not self.warmup_speakers or self.warming(engine):
+            return
+        engine.warmup_task = asyncio.create_task(self.warm_up(engine))
+
+    async def warm_up(self, engine):
+        # 設定されている話者を1つずつ読み込み、最初の合成で待たされないようにする
+        start = time.perf_counter()
+        loaded = 0
+        timeout = aiohttp.ClientTimeout(total=120)
+        for speaker_id in self.warmup_speakers:
+            if speaker_id in engine.loaded:
+                continue
+            speaker_start = time.perf_counter()
+            try:
+                async with self.session.get(f"{engine.url}/is_initialized_speaker",
+                                            params={'speaker': speaker_id}, timeout=timeout) as resp:
+                    resp.raise_for_status()
+                    initialized = await resp.json()
+                if not initialized:
+                    async with self.session.post(f"{engine.url}/initialize_speaker",
+                                                 params={'speaker': speaker_id, 'skip_reinit': 'true'},
+                                                 timeout=timeout) as resp:
+                        resp.raise_for_status()
+                    loaded += 1
+                    metrics.observe('speaker_warmup', time.perf_counter() - speaker_start,
+                                    endpoint=engine.url, speaker=speaker_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f'VoiceVoxエンジン {engine.url} の話者{speaker_id}を読み込めませんでした: {e}')
+                continue
+            engine.loaded.add(speaker_id)
+        logging.info(f'VoiceVoxエンジン {engine.url}: 話者 {len(engine.loaded)}/{len(self.warmup_speakers)} 読み込み済み'
+                     f'（新たに{loaded}件、{time.perf_counter() - start:.1f}秒）')
+
+    async def _post(self, path, read_json, engine=None, **kwargs):
+        # engine を指定した場合は最初にそのエンジンへ送り、失敗したときだけ他のエンジンで再試行する
+        if self.session is None:
+            await self.start()
+
+        tried = []
+        for attempt in range(self.retries + 1):
+            if engine is None or engine in tried or not engine.healthy:
+                engine = self.pick_engine(tried)
+            tried.append(engine)
+            engine.outstanding += 1
+            start = time.perf_counter()
+            try:
+                async with self.session.post(f"{engine.url}{path}", **kwargs) as resp:
+                    resp.raise_for_status()
+                    if read_json:
+                        result = await resp.json()
+                    else:
+                        result = await resp.read()
+                self.mark_success(engine)
+                metrics.observe('voicevox_request', time.perf_counter() - start, endpoint=engine.url, path=path)
+                return result
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc('voicevox_errors', endpoint=engine.url, path=path)
+                # 4xx はリトライしても結果が変わらないのでそのまま投げる
+                if isinstance(e, aiohttp.ClientResponseError) and e.status < 500:
+                    raise
+                self.mark_failure(engine)
+                if attempt >= self.retries:
+                    raise
+                # 別のエンジンが残っていればすぐに切り替え、なければ待ってから再試行する
+                if any(other.healthy and other not in tried for other in self.engines):
+                    logging.warning(f'VoiceVox {engine.url}{path} 失敗 ({e})、別のエンジンで再試行します')
+                    continue
+                delay = self.retry_backoff * (2 ** attempt)
+                logging.warning(f'VoiceVox {engine.url}{path} 失敗 ({e})、{delay:.2f}秒後に再試行します')
+                await asyncio.sleep(delay)
+                tried.clear()
+            finally:
+                engine.outstanding -= 1
+
+    async def audio_query(self, text, speaker_id, engine=None):
+        return await self._post('/audio_query', True, engine=engine, params={'text': text, 'speaker': speaker_id})
+
+    async def synthesis(self, audio_query, speaker_id, engine=None):
+        return await self._post('/synthesis', False, engine=engine, params={'speaker': speaker_id}, json=audio_query)
+
+    async def synthesize(self, text, speaker_id, intensity=None, pitch=None, speed=None, guild=None):
+        # guild ごとに公平に実行枠を割り当てる（キャッシュにあれば枠を使わない）
+        if self.cache is None:
+            return await self._synthesize(text, speaker_id, intensity, pitch, speed, guild)
+
+        key = self.cache.make_key(text, speaker_id, intensity, pitch, speed)
+        audio_content = await self.cache.get(key)
+        if audio_content is None:
+            audio_content = await self._synthesize(text, speaker_id, intensity, pitch, speed, guild)
+            await self.cache.put(key, audio_content)
+        return audio_content
+
+    async def _synthesize(self, text, speaker_id, intensity, pitch, speed, guild=None):
+        start = time.perf_counter()
+        async with self.scheduler.slot(guild):
+            metrics.observe('synthesis_slot_wait', time.perf_counter() - start, guild=guild)
+            # 枠の数は割り当て先のエンジンの台数分なので、同時合成数に余裕のあるエンジンが必ず残っている
+            engine = self.pick_slot_engine()
+            engine.inflight += 1
+            try:
+                return await self._synthesize_now(text, speaker_id, intensity, pitch, speed, engine)
+            finally:
+                engine.inflight -= 1
+
+    async def _synthesize_now(self, text, speaker_id, intensity, pitch, speed, engine=None):
+        audio_query = await self.audio_query(text, speaker_id, engine)
+        if intensity is not None:
+            audio_query['intonationScale'] = intensity
+        if pitch is not None:
+            audio_query['pitchScale'] = pitch
+        if speed is not None:
+            audio_query['speedScale'] = speed
+        return await self.synthesis(audio_query, speaker_id, engine)
+
+
+def parse_weights(value):
+    # "サーバーID:重み,サーバーID:重み" の形式
+    weights = {}
+    for item in value.split(','):
+        if ':' in item:
+            guild_id, weight = item.split(':', 1)
+            weights[int(guild_id.strip())] = max(1, int(weight.strip()))
+    return weights
+
+
+def configured_speaker_ids(path='config.json'):
+    # config.json の既定の話者と、speaker_style_options のすべてのスタイルID
+    try:
+        with open(path, 'r', encoding='utf-8') as config_file:
+            config = json.load(config_file)
+    except (OSError, ValueError) as e:
+        logging.warning(f'{path} から話者を読み込めませんでした: {e}')
+        return []
+    speaker_ids = [config.get('default_speaker_id')]
+    for styles in config.get('speaker_style_options', {}).values():
+        speaker_ids.extend(styles.values())
+    return [speaker_id for speaker_id in speaker_ids if isinstance(speaker_id, int)]